@@ -2,6 +2,7 @@ DROP TABLE IF EXISTS books;
 DROP TABLE IF EXISTS publishers; 
 DROP TABLE IF EXISTS authors; 
 DROP TABLE IF EXISTS categories;
+DROP TABLE IF EXISTS fingerprints;
 
 CREATE TABLE books (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -12,20 +13,39 @@ CREATE TABLE books (
     `category_id` INTEGER,
     `destination` TEXT NOT NULL,
     `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
-    `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP
+    `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    `title_key` TEXT,
+    `original_size` INTEGER,
+    `optimized_size` INTEGER
 );
 
 CREATE TABLE publishers (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-    `name` TEXT NOT NULL
+    `name` TEXT NOT NULL,
+    `key` TEXT
 );
 
 CREATE TABLE authors (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-    `name` TEXT NOT NULL
+    `name` TEXT NOT NULL,
+    `key` TEXT
 );
 
 CREATE TABLE categories (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-    `name` TEXT NOT NULL
+    `name` TEXT NOT NULL,
+    `key` TEXT
 );
+
+-- 表紙と裏表紙のdifference hash. 64bitを符号付きで格納する
+CREATE TABLE fingerprints (
+    `book_id` INTEGER PRIMARY KEY,
+    `cover` INTEGER NOT NULL,
+    `back` INTEGER
+);
+
+CREATE INDEX idx_books_title_key ON books(title_key);
+CREATE INDEX idx_books_destination ON books(destination);
+CREATE INDEX idx_publishers_key ON publishers(key);
+CREATE INDEX idx_authors_key ON authors(key);
+CREATE INDEX idx_categories_key ON categories(key);
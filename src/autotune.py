@@ -0,0 +1,285 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, Optional
+
+if TYPE_CHECKING:
+    from metrics import RunMetrics
+    from pipeline import BookPipeline
+
+DEFAULT_AUTOTUNE_CONFIG = {
+    "enabled": False,    # TrueでOCRと取得の並列数をpipelineの値を上限に自動で調整する
+    "interval_seconds": 15,    # 何秒ごとに調整するか
+    "rss_limit_mb": None,    # 全プロセスのRSSの上限(MB). Noneなら起動時の空きメモリの8割
+    "ocr_memory_mb": 300,    # OCR 1並列あたりのメモリの見積もり(MB)
+    "lookup_memory_mb": 400    # 取得1並列あたりのメモリの見積もり(MB). e-honのChromeを含む
+}
+
+_MB = 1 << 20
+_REGRESSION = 0.9    # 並列数を増やした後の処理能力がこれを下回ったら戻す
+_NOT_FOUND_ERROR = "DoesNotHaveDataError"    # 本が無いだけで混雑とは関係ない取得のエラー
+_THROTTLED = ".throttled"    # 取得先がアクセスを制限したときの数(honto.throttledなど)
+_THROTTLED_ERROR = "ThrottledError"    # 制限されたときの取得のエラー. _THROTTLEDで数えている
+
+
+def cpu_count() -> int:
+    """このプロセスが使えるCPUの数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory(meminfo: Path = Path("/proc/meminfo")) -> Optional[int]:
+    """新しいプロセスに使える空きメモリ(byte). /procが無ければNone"""
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_tree_rss(pid: Optional[int] = None, proc: Path = Path("/proc")) -> int:
+    """pidとその子孫のプロセス(OCRのプール、tesseract、Chromeなど)のRSSの合計(byte)
+
+    /procが無ければ0を返す
+
+    Args:
+        pid (Optional[int], optional): 根のプロセス. 省略時はこのプロセス
+        proc (Path, optional): procfsの場所
+
+    Returns:
+        int: RSSの合計
+    """
+    root = os.getpid() if pid is None else pid
+    children: Dict[int, list] = {}
+    try:
+        entries = [entry for entry in os.scandir(proc) if entry.name.isdigit()]
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            with open(os.path.join(entry.path, "stat")) as f:
+                stat = f.read()
+        except OSError:
+            continue    # 読む前に終わったプロセス
+        # 2番目の(comm)は空白や括弧を含みうるので最後の")"の後ろから数える
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(proc / str(current) / "statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+        stack.extend(children.get(current, []))
+    return total
+
+
+class AutoTuner:
+    """パイプラインのOCRと取得の並列数を実行中に調整する
+
+    一定間隔で全プロセスのRSS、各ステージの処理待ちの数と処理時間を測り、1回に1段階だけ変える
+    * RSSが上限を超えたら、メモリを多く使っている方の並列数を減らす
+    * 取得先がアクセスを制限するか(hontoの429/503など)、本が無い以外の取得のエラーが増えたら
+      取得の並列数を減らす
+    * 並列数を増やした後に ステージの処理能力(並列数 / 平均処理時間) が下がったら元に戻し、その数を上限とする
+    * 処理待ちが溜まっているステージは、メモリとCPUに余裕があれば並列数を増やす
+    """
+    def __init__(self,
+                 pipeline: "BookPipeline",
+                 metrics: "RunMetrics",
+                 rss_limit: Optional[int] = None,
+                 ocr_memory: int = 300 * _MB,
+                 lookup_memory: int = 400 * _MB,
+                 interval: float = 15,
+                 log: Callable[[str], None] = print,
+                 rss: Callable[[], int] = process_tree_rss,
+                 cpus: Optional[int] = None,
+                 available: Callable[[], Optional[int]] = available_memory) -> None:
+        """initialize
+
+        Args:
+            pipeline (BookPipeline): 調整するパイプライン. ocr_workersとlookup_workersが並列数の上限になる
+            metrics (RunMetrics): 処理時間とエラー数を読むRunMetrics. 調整の内容もここに書く
+            rss_limit (Optional[int], optional): RSSの上限(byte). 省略時は起動時の空きメモリの8割
+            ocr_memory (int, optional): OCR 1並列あたりのメモリの見積もり(byte)
+            lookup_memory (int, optional): 取得1並列あたりのメモリの見積もり(byte)
+            interval (float, optional): 調整の間隔(秒)
+            log (Callable[[str], None], optional): 調整の内容を書く関数
+            rss (Callable[[], int], optional): 現在のRSSを返す関数
+            cpus (Optional[int], optional): 使えるCPUの数. 省略時は調べる
+            available (Callable[[], Optional[int]], optional): 空きメモリを返す関数
+        """
+        self.pipeline = pipeline
+        self.metrics = metrics
+        self.ocr_memory = ocr_memory
+        self.lookup_memory = lookup_memory
+        self.interval = interval
+        self.log = log
+        self.rss = rss
+        self.available = available
+        self.cpus = cpus or cpu_count()
+        free = available()
+        if rss_limit is None and free is not None:
+            rss_limit = int(free * 0.8)
+        self.rss_limit = rss_limit
+        self.limits = {"ocr": pipeline.ocr_limit, "lookup": pipeline.lookup_limit}
+        self.memory = {"ocr": ocr_memory, "lookup": lookup_memory}
+        self.ceilings = {
+            "ocr": min(pipeline.ocr_workers, self.cpus),
+            "lookup": pipeline.lookup_workers
+        }
+        self._seen = {"ocr": 0, "lookup": 0}
+        self._errors = self._throttle_signals()
+        self._last_change: Optional[tuple] = None    # (ステージ, 前の並列数, 前の処理能力)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def initial_limits(self) -> Dict[str, int]:
+        """CPUの数とメモリから最初の並列数を決める
+
+        Returns:
+            Dict[str, int]: ステージごとの並列数
+        """
+        budget = self.rss_limit
+        free = self.available()
+        if free is not None:
+            budget = free if budget is None else min(budget, free)
+        ocr = self.ceilings["ocr"]
+        lookup = self.ceilings["lookup"]
+        if budget is not None:
+            # 半分をOCRに、残りを取得に割り当てる
+            ocr = min(ocr, max(1, budget // (2 * self.ocr_memory)))
+            lookup = min(lookup, max(1, (budget - ocr * self.ocr_memory) // self.lookup_memory))
+        self._set("ocr", ocr, f"cpus={self.cpus}, budget={_to_mb(budget)}MB")
+        self._set("lookup", lookup, f"cpus={self.cpus}, budget={_to_mb(budget)}MB")
+        return {stage: limit.limit for stage, limit in self.limits.items()}
+
+    def step(self) -> Optional[str]:
+        """測定して並列数を1段階だけ変える
+
+        Returns:
+            Optional[str]: 変えたときはその内容
+        """
+        rss = self.rss()
+        depths = self.pipeline.queue_depths()
+        throughput = {stage: self._throughput(stage) for stage in self.limits}
+        errors = self._throttle_signals()
+        new_errors, self._errors = errors - self._errors, errors
+
+        if self.rss_limit is not None and rss > self.rss_limit:
+            usage = {
+                stage: limit.limit * self.memory[stage]
+                for stage, limit in self.limits.items() if limit.limit > 1
+            }
+            if usage:
+                stage = max(usage, key=usage.get)
+                return self._change(stage, -1,
+                                    f"rss={_to_mb(rss)}MB > {_to_mb(self.rss_limit)}MB")
+            return None
+
+        if new_errors > 0 and self.limits["lookup"].limit > 1:
+            return self._change("lookup", -1, f"throttled or lookup errors +{new_errors}")
+
+        if self._last_change is not None:
+            stage, previous, before = self._last_change
+            after = throughput[stage]
+            if after is None:
+                return None    # まだ測れていない
+            self._last_change = None
+            if before is not None and after < before * _REGRESSION:
+                self.ceilings[stage] = previous
+                return self._change(stage, previous - self.limits[stage].limit,
+                                    f"throughput {before:.3f} -> {after:.3f} books/s")
+
+        for stage in ("ocr", "lookup"):
+            limit = self.limits[stage].limit
+            if depths.get(stage, 0) < max(1, self.pipeline.queue_size // 2):
+                continue
+            if limit >= self.ceilings[stage]:
+                continue
+            free = self.available()
+            if free is not None and free < self.memory[stage]:
+                continue
+            if self.rss_limit is not None and rss + self.memory[stage] > self.rss_limit:
+                continue
+            reason = f"{stage} queue={depths[stage]}, rss={_to_mb(rss)}MB"
+            self._last_change = (stage, limit, throughput[stage])
+            return self._change(stage, +1, reason)
+        return None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def running(self) -> Iterator["AutoTuner"]:
+        """withの間interval秒ごとにstepする"""
+        self.initial_limits()
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                # 測れなくても処理は止めない
+                self.log(f"autotune failed. {type(e).__name__}: {e}")
+
+    def _throughput(self, stage: str) -> Optional[float]:
+        """前回から終わったジョブの平均処理時間から、ステージが1秒に処理できる冊数を見積もる"""
+        seconds = self.metrics.timings_since(stage, self._seen[stage])
+        self._seen[stage] += len(seconds)
+        if not seconds:
+            return None
+        return self.limits[stage].limit / (sum(seconds) / len(seconds))
+
+    def _throttle_signals(self) -> int:
+        """取得先の制限の回数と、本が無い以外の取得のエラーの数の合計"""
+        total = 0
+        for name, n in self.metrics.counts().items():
+            if name.endswith(_THROTTLED):
+                total += n
+            elif name.startswith("error.lookup.") and not name.endswith(
+                    (_NOT_FOUND_ERROR, _THROTTLED_ERROR)):
+                total += n
+        return total
+
+    def _change(self, stage: str, delta: int, reason: str) -> Optional[str]:
+        return self._set(stage, self.limits[stage].limit + delta, reason)
+
+    def _set(self, stage: str, limit: int, reason: str) -> Optional[str]:
+        previous = self.limits[stage].limit
+        current = self.limits[stage].set(min(limit, self.ceilings[stage]))
+        if current == previous:
+            return None
+        message = f"{stage} {previous} -> {current} ({reason})"
+        self.log(message)
+        self.metrics.event("autotune", stage=stage, previous=previous, limit=current,
+                           reason=reason)
+        return message
+
+
+def _to_mb(n: Optional[int]) -> Optional[int]:
+    return None if n is None else n // _MB
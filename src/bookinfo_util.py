@@ -1,4 +1,6 @@
 import re
+import unicodedata
+from functools import lru_cache
 
 corpus = {
     **{z: str(h)
@@ -12,7 +14,20 @@ c_operator = {"?": "？", "!": "！"}    # !や?はパスに入ると演算子
 z2h = str.maketrans(corpus)    # 全角数字->半角数字のtranslaterを作成
 safe_operator = str.maketrans(c_operator)
 
+# 1回のtranslateで済むように置換をまとめた表
+_title_table = str.maketrans({**corpus, **{c: " " for c in '（）　:<>/="'}})
+_publisher_table = str.maketrans({**corpus, "・": None})
 
+_option_pattern = re.compile(r"【.+】")
+_spaces_pattern = re.compile(" +")
+_author_role_pattern = re.compile(r"[\(（].+?[\)）]")
+_author_space_pattern = re.compile(r"\s")
+_key_ignore_pattern = re.compile(r"[\s\W_]+")    # 比較用のキーでは記号と空白を無視する
+
+_MEMO_SIZE = 4096
+
+
+@lru_cache(maxsize=_MEMO_SIZE)
 def format_title(title: str) -> str:
     """入力文字列を整形する
 
@@ -22,19 +37,50 @@ def format_title(title: str) -> str:
     Returns:
         str: 整形した文字列
     """
-    half_width = re.sub('[（）　:<>/="]', ' ', title)
-    deleted_option = re.sub(r"【.+】", "", half_width)
-    deleted_option.translate(safe_operator)
-    return re.sub(' +', '_', deleted_option.translate(z2h).strip())
+    deleted_option = _option_pattern.sub("", title.translate(_title_table))
+    return _spaces_pattern.sub("_", deleted_option.strip())
+
+
+@lru_cache(maxsize=_MEMO_SIZE)
+def _format_author(author: str) -> str:
+    without_role = _author_role_pattern.sub("", author)
+    return _author_space_pattern.sub("", without_role).translate(z2h)
 
 
 def format_authors(authors: list) -> list:
-    formatted = [re.sub(r"[\(（].+?[\)）]", "", author) for author in authors]
-    formatted = [re.sub(r"\s", "", author) for author in formatted]
-    return [f.translate(z2h) for f in formatted]
+    return [_format_author(author) for author in authors]
 
 
+@lru_cache(maxsize=_MEMO_SIZE)
 def format_publisher(publisher: str) -> str:
-    formatted = re.sub("・", "", publisher)
-    formatted = formatted.translate(z2h)
-    return formatted
+    return publisher.translate(_publisher_table)
+
+
+@lru_cache(maxsize=_MEMO_SIZE)
+def normalize_key(name: str) -> str:
+    """表記ゆれを吸収した比較用のキーを返す
+
+    NFKCで正規化し、大文字小文字と記号、空白を無視する
+
+    Args:
+        name (str): タイトルや出版社名など
+
+    Returns:
+        str: 比較用のキー
+    """
+    return _key_ignore_pattern.sub("", unicodedata.normalize("NFKC", name).casefold())
+
+
+def title_key(title: str) -> str:
+    """タイトルの比較用のキーを返す. 【】などの付加情報は無視する"""
+    return normalize_key(format_title(title))
+
+
+def authors_key(authors: list) -> str:
+    """著者の比較用のキーを返す. 著者の並び順は無視する"""
+    return "\t".join(sorted(normalize_key(author) for author in format_authors(authors)))
+
+
+def publisher_key(publisher: str) -> str:
+    """出版社の比較用のキーを返す"""
+    return normalize_key(format_publisher(publisher))
@@ -1,96 +1,207 @@
 import re
 import csv
-import shutil
+import os
 from argparse import ArgumentParser, Namespace
+from functools import partial
 from pathlib import Path
+from typing import Iterable, Iterator, Optional, Set
 
 import yaml
 
+from config import load_section
 from databese import DatabaseCliant
-from ehon import EhonSearchCliant
-from honto import HontoDoesNotHaveDataError, HontoSearchCliant
+from filing import DEFAULT_FILING_CONFIG, BookFiler
+from isbn import to_isbn13
+from metrics import RunMetrics
 from mylogger import MyLogger
-from run import construct_dst, fetch_book_info_from_isbn, send_err_dir
+from pipeline import DEFAULT_PIPELINE_CONFIG, BookJob, BookPipeline
+from run import TRANSIENT_LOOKUP_ERRORS, BookInfoFetcher, file_book, scan_isbn_or_raise
 
 
 def completion_no_isbn(source_csv_path: str) -> None:
     """手作業でisbnや移動先を書いたcsvを元に補完作業をする
 
+    isbnの行は並行して書籍情報を取得し、移動とデータベースへの書き込みはまとめて確定する
+    行ごとの結果は"[csv名].result.csv"に書き、もう一度実行すると書かれている行を飛ばして再開する
+
     Args:
         source_csv_path (str): ソースとなるcsv
     """
     logger = MyLogger()
-    honto = HontoSearchCliant()
-    ehon = EhonSearchCliant()
+    project_dir = Path(__file__).resolve().parents[1]
 
-    with open(Path(__file__).resolve().parents[1] / "config.yml") as f:
+    with open(project_dir / "config.yml") as f:
         config = yaml.safe_load(f)
         Path(config["output_dir"]).resolve().mkdir(exist_ok=True, parents=True)
 
-    db_cliant = DatabaseCliant(Path(config["database_path"]))
+    metrics = RunMetrics(project_dir / "book_metrics.jsonl")
+    db_cliant = DatabaseCliant(Path(config["database_path"]), metrics, autocommit=False)
+    filer = BookFiler(metrics=metrics,
+                      **load_section(config, "filing", DEFAULT_FILING_CONFIG))
+    # isbnの行はOCRを飛ばして書籍情報の取得から始める
+    pipeline = BookPipeline(scan_isbn_or_raise, partial(BookInfoFetcher, metrics),
+                            metrics=metrics,
+                            **load_section(config, "pipeline", DEFAULT_PIPELINE_CONFIG))
 
     csv_path = Path(source_csv_path).resolve()
-    with open(csv_path) as f:
-        reader = csv.reader(f)
-        for row in reader:
-            book_path = Path(row[0]).resolve()
-            neemock = str(row[1])
-            if re.fullmatch(r"[0-9-]+", neemock):
-                isbn = neemock
-                try:
-                    store_specified_isbn(book_path, isbn, honto, ehon, config, logger,
-                                         db_cliant)
-                except HontoDoesNotHaveDataError as e:
-                    send_err_dir(book_path, Path(config["output_dir"]))
-                    logger.write("ERROR", str(e))
-            else:
-                dst = Path(neemock)
-                db_cliant.update_dst(book_path, dst)
-                shutil.move(str(book_path), str(dst / book_path.name))
-
-    db_cliant.close()
-
-
-def store_specified_isbn(target: Path, isbn: str, honto: HontoSearchCliant,
-                         ehon: EhonSearchCliant, config: dict, logger: MyLogger,
-                         db: DatabaseCliant) -> None:
-    """isbnを元に元情報を上書きし、移動する
+    report = CompletionReport(csv_path.with_name(csv_path.stem + ".result.csv"))
+    with open(csv_path, newline="") as f:
+        try:
+            pipeline.run(
+                read_jobs(csv.reader(f), report.done),
+                lambda job: file_csv_row(job, config, logger, db_cliant, filer, report, metrics))
+        finally:
+            # 途中で止まってもそこまでの結果は確定して再開できるようにする
+            commit_batch(filer, db_cliant, report)
+            report.close()
+            db_cliant.close()
+            metrics.write_summary()
+            metrics.close()
+
+
+class CompletionReport:
+    """csvの行ごとの処理結果を書き出すクラス
+
+    [元のファイル, 2列目の値, SUCCESS/ERROR/MISSING, 移動先またはエラー内容]の形式で書く
+    """
+    def __init__(self, path: Path) -> None:
+        """以前の結果があれば読み込み、追記できるように開く
+
+        Args:
+            path (Path): 結果を書くcsvのpath
+        """
+        self.path = path
+        self.done: Set[str] = set()    # 処理済みの元のファイル
+        if path.exists():
+            with open(path, newline="") as f:
+                self.done = {row[0] for row in csv.reader(f) if row}
+        self._pending = []
+        self._fp = open(path, "a", newline="")
+        self._writer = csv.writer(self._fp)
+
+    def __len__(self) -> int:
+        """まだ書き出していない行数"""
+        return len(self._pending)
+
+    def add(self, job: BookJob, status: str, detail: str) -> None:
+        value = job.isbn if job.isbn is not None else str(job.dst)
+        self._pending.append([str(job.path), value, status, detail])
+
+    def commit(self) -> None:
+        """溜めていた行を書き出す
+        """
+        self._writer.writerows(self._pending)
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self.done.update(row[0] for row in self._pending)
+        self._pending = []
+
+    def close(self) -> None:
+        self._fp.close()
+
+
+def read_jobs(reader: Iterable[list], done: Set[str] = frozenset()) -> Iterator[BookJob]:
+    """csvの行をジョブに変換する
 
     Args:
-        target (Path): 対象書籍のpath
-        isbn (str): isbn
-        honto (HontoSearchCliant): Hontoの検索クライアント
-        ehon (EhonSearchCliant): E-honの検索クライアント
+        reader (Iterable[list]): csv.reader
+        done (Set[str], optional): 処理済みなので飛ばす元のファイル
+
+    Yields:
+        BookJob: 2列目がisbnならisbnを、そうでなければ移動先を指定したジョブ.
+            元のファイルが無ければFileNotFoundErrorを、isbnのチェックディジットが合わなければ
+            InvalidIsbnErrorを持つジョブ
+    """
+    for row in reader:
+        book_path = Path(row[0]).resolve()
+        if str(book_path) in done:
+            continue
+        neemock = str(row[1])
+        if re.fullmatch(r"[0-9-]+[0-9Xx]", neemock):
+            isbn = to_isbn13(neemock)
+            job = BookJob(book_path, isbn=isbn or neemock)
+            if isbn is None:
+                job.error = InvalidIsbnError(f"Invalid isbn. {neemock=}")
+        else:
+            job = BookJob(book_path, dst=Path(neemock))
+        if not book_path.exists():
+            job.error = FileNotFoundError(f"Not found the book. {book_path=}")
+        yield job
+
+
+def file_csv_row(job: BookJob,
+                 config: dict,
+                 logger: MyLogger,
+                 db: DatabaseCliant,
+                 filer: BookFiler,
+                 report: CompletionReport,
+                 metrics: Optional[RunMetrics] = None) -> None:
+    """csvの1行分の書籍を移動し、データベースに書き込む
+
+    filerのbatch_size行ごとに移動とデータベースへの書き込みを確定し、結果を書き出す
+    SUCCESSの結果は移動が確定してから加えるので、確定できなかった行は再実行でやり直す
+    想定外のエラーもその行のERRORとして書き、残りの行は続ける
+
+    Args:
+        job (BookJob): 処理の終わったジョブ
         config (dict): configのdict
         logger (MyLogger): logger
         db (DatabaseCliant): データベースのクライアント
-
-    Raises:
-        HontoDoesNotHaveDataError: Hontoがその書籍のページを持っていないときのエラー
+        filer (BookFiler): 移動に使うBookFiler
+        report (CompletionReport): 行ごとの結果の書き出し先
+        metrics (Optional[RunMetrics], optional): 処理した冊数の記録先
     """
-    try:
-        info = fetch_book_info_from_isbn(isbn, honto, ehon)
-    except HontoDoesNotHaveDataError as e:
-        send_err_dir(target, Path(config["output_dir"]))
-        logger.write("ERROR", str(e))
-        raise HontoDoesNotHaveDataError(e)
+    if isinstance(job.error, FileNotFoundError):
+        report.add(job, "MISSING", str(job.error))
+    elif isinstance(job.error, InvalidIsbnError):
+        # csvを直して再実行できるようにファイルは動かさない
+        report.add(job, "ERROR", str(job.error))
+    elif job.dst is not None:
+
+        def publish(dst: Path) -> None:
+            db.update_dst(job.path, dst)
+            report.add(job, "SUCCESS", str(dst))
+
+        try:
+            filer.move(job.path, job.dst / job.path.name, publish)
+        except Exception as e:
+            report.add(job, "ERROR", f"{type(e).__name__}: {e}")
     else:
-        dst = construct_dst(config["output_dir"], info)
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        shutil.move(str(target), dst)
-        logger.write("SUCCESS", str(dst))
-
-        # データベースに情報を追加
-        fetch_result = {
-            "title": info["title"],
-            "isbn": info["isbn"],
-            "authors": "\t".join(info["authors"] or [""]),
-            "publishers": info["publisher"],
-            "categories": info["category"],
-            "destination": str(dst)
-        }
-
-        db.store(fetch_result)
+
+        def publish(dst: Path) -> None:
+            if job.error is None:
+                report.add(job, "SUCCESS", str(dst))
+
+        try:
+            dst = file_book(job, config, logger, db, filer, metrics, on_publish=publish)
+        except Exception as e:
+            # 同じ行で再実行のたびに止まらないように、結果に書いて次の行へ進む
+            logger.write("ERROR", f"{job.path}: {type(e).__name__}: {e}")
+            report.add(job, "ERROR", f"{type(e).__name__}: {e}")
+        else:
+            # 取得が一時的に失敗した行は結果に書かず、再実行でやり直す
+            if dst is None and not isinstance(job.error, TRANSIENT_LOOKUP_ERRORS):
+                report.add(job, "ERROR", str(job.error))
+
+    if len(report) >= filer.batch_size:
+        commit_batch(filer, db, report)
+
+
+def commit_batch(filer: BookFiler, db: DatabaseCliant, report: CompletionReport) -> None:
+    """移動 -> データベース -> 結果の順に確定する
+
+    Args:
+        filer (BookFiler): 移動に使うBookFiler
+        db (DatabaseCliant): データベースのクライアント
+        report (CompletionReport): 行ごとの結果の書き出し先
+    """
+    filer.flush()
+    db.commit()
+    report.commit()
+
+
+class InvalidIsbnError(Exception):
+    pass
 
 
 def parser() -> Namespace:
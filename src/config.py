@@ -0,0 +1,12 @@
+def load_section(config: dict, name: str, defaults: dict) -> dict:
+    """config.ymlのname項目を既定値で補完して返す
+
+    Args:
+        config (dict): configのdict
+        name (str): 項目名
+        defaults (dict): 項目の既定値
+
+    Returns:
+        dict: 既定値で補完したdict
+    """
+    return {**defaults, **(config.get(name) or {})}
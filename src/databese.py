@@ -1,28 +1,105 @@
 import sqlite3
 from pathlib import Path
+from typing import List, Optional, Tuple
+
+import bookinfo_util
+from fingerprint import to_signed, to_unsigned
+from metrics import RunMetrics
+
+# 最適化の前後のファイルサイズ. 古いデータベースには無い
+SIZE_COLUMNS = ("original_size", "optimized_size")
+
+# 比較用のキーを持つ列. 表記ゆれがあっても同じ行を引けるように索引を張る
+KEY_COLUMNS = {
+    "books": ("title", "title_key"),
+    "publishers": ("name", "key"),
+    "authors": ("name", "key"),
+    "categories": ("name", "key")
+}
+
+
+def make_key(table: str, name: str) -> str:
+    """tableの行の比較用のキーを返す
+
+    Args:
+        table (str): テーブル名
+        name (str): 書名や出版社名など. 著者はタブ区切りで複数人
+
+    Returns:
+        str: 比較用のキー
+    """
+    if table == "books":
+        return bookinfo_util.title_key(name)
+    elif table == "authors":
+        return bookinfo_util.authors_key(name.split("\t"))
+    elif table == "publishers":
+        return bookinfo_util.publisher_key(name)
+    return bookinfo_util.normalize_key(name)
 
 
 class DatabaseCliant:
-    def __init__(self, database_path: Path) -> None:
+    def __init__(self,
+                 database_path: Path,
+                 metrics: Optional[RunMetrics] = None,
+                 autocommit: bool = True) -> None:
         """initialize
 
         Args:
             database_path (Path): データベースのpath
+            metrics (Optional[RunMetrics], optional): 書き込み時間の記録先
+            autocommit (bool, optional): Falseならstoreなどでcommitせず、commit()を呼んだときにまとめて書き込む
         """
+        self.metrics = metrics or RunMetrics()
+        self.autocommit = autocommit
         self.dst = database_path
         if not self.dst.exists():
             self.dst.touch()
             self.connection = sqlite3.connect(self.dst)
-            self.run_by_file(self.dst.parent / "schema.sql")
+            self.run_by_file(Path(__file__).resolve().parents[1] / "schema.sql")
         else:
             self.connection = sqlite3.connect(self.dst)
         self.connection.row_factory = sqlite3.Row
+        self._migrate()
 
     def close(self) -> None:
-        """connectionを切断する
+        """connectionを切断する. commitしていない書き込みは捨てる
         """
         self.connection.close()
 
+    def _migrate(self) -> None:
+        """古いデータベースに足りない列と索引を追加する
+        """
+        c = self.connection.cursor()
+        for table, (source, column) in KEY_COLUMNS.items():
+            columns = {row["name"] for row in c.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+                rows = c.execute(f"SELECT id, {source} FROM {table}").fetchall()
+                c.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?",
+                              [(make_key(table, row[source] or ""), row["id"]) for row in rows])
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table}({column})")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_books_destination ON books(destination)")
+        columns = {row["name"] for row in c.execute("PRAGMA table_info(books)")}
+        for column in SIZE_COLUMNS:
+            if column not in columns:
+                c.execute(f"ALTER TABLE books ADD COLUMN {column} INTEGER")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                `book_id` INTEGER PRIMARY KEY,
+                `cover` INTEGER NOT NULL,
+                `back` INTEGER
+            )""")
+        self.connection.commit()
+
+    def commit(self) -> None:
+        """まとめていた書き込みを確定する
+        """
+        self.connection.commit()
+
+    def _autocommit(self) -> None:
+        if self.autocommit:
+            self.connection.commit()
+
     def run_by_file(self, path: Path) -> None:
         """SQLファイルを読み込み実行する(初期化)
 
@@ -33,18 +110,46 @@ class DatabaseCliant:
         with open(path) as f:
             c.executescript(f.read())
 
-    def store(self, data: dict) -> None:
+    def store(self, data: dict) -> int:
         """書籍データをデータべースに格納する
 
         Args:
             data (dict): 書籍データのdict
+
+        Returns:
+            int: 格納した書籍のid
         """
-        c = self.connection.cursor()
-        params = self._build_query_params(data)
-        c.execute(
-            "INSERT INTO books(title, isbn, publisher_id, author_id, category_id, destination) VALUES(?, ?, ?, ?, ?, ?)",
-            params)
-        self.connection.commit()
+        with self.metrics.time("db.store"):
+            c = self.connection.cursor()
+            params = self._build_query_params(data)
+            c.execute(
+                "INSERT INTO books(title, isbn, publisher_id, author_id, category_id, destination, title_key) VALUES(?, ?, ?, ?, ?, ?, ?)",
+                params)
+            self._autocommit()
+            return c.lastrowid
+
+    def store_fingerprint(self, book_id: int, cover: int, back: Optional[int] = None) -> None:
+        """書籍の表紙と裏表紙の指紋を格納する
+
+        Args:
+            book_id (int): 書籍のid
+            cover (int): 表紙の指紋
+            back (Optional[int], optional): 裏表紙の指紋
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO fingerprints (book_id, cover, back) VALUES(?, ?, ?)",
+            (book_id, to_signed(cover), None if back is None else to_signed(back)))
+        self._autocommit()
+
+    def load_fingerprints(self) -> List[Tuple[str, int, Optional[int], Optional[str]]]:
+        """指紋のある全書籍の(移動先, 表紙の指紋, 裏表紙の指紋, isbn)を返す
+        """
+        rows = self.connection.execute("""
+            SELECT b.destination, f.cover, f.back, b.isbn
+            FROM fingerprints f JOIN books b ON f.book_id = b.id""")
+        return [(row["destination"], to_unsigned(row["cover"]),
+                 None if row["back"] is None else to_unsigned(row["back"]), row["isbn"])
+                for row in rows]
 
     def _build_query_params(self, data: dict) -> tuple:
         """別テーブルに分けた出版社、著者、カテゴリのidを取得し、整形する
@@ -59,11 +164,11 @@ class DatabaseCliant:
         for key in outer_key.keys():
             outer_key[key] = self.select_individual_id(key, data[key])
 
-        return (data["title"], data["isbn"], outer_key["publishers"],
-                outer_key["authors"], outer_key["categories"], data["destination"])
+        return (data["title"], data["isbn"], outer_key["publishers"], outer_key["authors"],
+                outer_key["categories"], data["destination"], make_key("books", data["title"]))
 
     def select_individual_id(self, table: str, column: str) -> int:
-        """別テーブルに分けたIDを取得する
+        """別テーブルに分けたIDを取得する. 表記ゆれは比較用のキーで吸収する
 
         Args:
             table (str): 取得元のtable名
@@ -73,26 +178,129 @@ class DatabaseCliant:
             int: columnに対応するID
         """
         c = self.connection.cursor()
-        base_query = f"SELECT id FROM {table} WHERE name=?"    # テーブル名に?を埋め込むことはできない
-        columns_id = c.execute(base_query, (column, )).fetchone()
+        key = make_key(table, column)
+        base_query = f"SELECT id FROM {table} WHERE key=?"    # テーブル名に?を埋め込むことはできない
+        columns_id = c.execute(base_query, (key, )).fetchone()
         if columns_id is None:
-            c.execute(f"INSERT INTO {table}(name) VALUES(?)", (column, ))
-            self.connection.commit()
-            columns_id = c.execute(base_query, (column, )).fetchone()
+            c.execute(f"INSERT INTO {table}(name, key) VALUES(?, ?)", (column, key))
+            columns_id = c.execute(base_query, (key, )).fetchone()
         return columns_id["id"]
 
+    def update_sizes(self, sizes: List[Tuple[str, int, int]]) -> None:
+        """最適化の前後のファイルサイズを書き込む
+
+        Args:
+            sizes (List[Tuple[str, int, int]]): (移動先, 最適化前のサイズ, 最適化後のサイズ)
+        """
+        self.connection.executemany(
+            "UPDATE books SET original_size = ?, optimized_size = ?, updated_at = CURRENT_TIMESTAMP WHERE destination = ?",
+            [(original, optimized, destination) for destination, original, optimized in sizes])
+        self._autocommit()
+
+    def merge_from(self, other_path: Path) -> int:
+        """別のカタログの書籍を取り込む. 移動先が同じ書籍はすでにあるものとして飛ばす
+
+        Args:
+            other_path (Path): 取り込むカタログのpath
+
+        Returns:
+            int: 取り込んだ書籍の数
+        """
+        other = sqlite3.connect(other_path)
+        other.row_factory = sqlite3.Row
+        try:
+            rows = other.execute("""
+                SELECT b.title, b.isbn, b.destination, p.name AS publishers, a.name AS authors,
+                       c.name AS categories, f.cover, f.back, b.original_size, b.optimized_size
+                FROM books b
+                LEFT JOIN publishers p ON b.publisher_id = p.id
+                LEFT JOIN authors a ON b.author_id = a.id
+                LEFT JOIN categories c ON b.category_id = c.id
+                LEFT JOIN fingerprints f ON f.book_id = b.id
+                ORDER BY b.id""").fetchall()
+        finally:
+            other.close()
+
+        autocommit, self.autocommit = self.autocommit, False
+        c = self.connection.cursor()
+        n_merged = 0
+        try:
+            for row in rows:
+                if c.execute("SELECT 1 FROM books WHERE destination = ?",
+                             (row["destination"], )).fetchone():
+                    continue
+                if row["categories"] is None:
+                    # 手作業で移動先だけを指定した書籍
+                    c.execute("INSERT INTO books (title, destination, title_key) VALUES(?, ?, ?)",
+                              (row["title"], row["destination"], make_key("books", row["title"])))
+                else:
+                    book_id = self.store(dict(row))
+                    if row["cover"] is not None:
+                        c.execute("INSERT OR REPLACE INTO fingerprints VALUES(?, ?, ?)",
+                                  (book_id, row["cover"], row["back"]))
+                    if row["original_size"] is not None:
+                        c.execute("UPDATE books SET original_size = ?, optimized_size = ? WHERE id = ?",
+                                  (row["original_size"], row["optimized_size"], book_id))
+                n_merged += 1
+            self.connection.commit()
+        finally:
+            self.autocommit = autocommit
+        return n_merged
+
+    def list_destinations(self) -> List[Tuple[int, str]]:
+        """全書籍の(id, 移動先)を返す
+        """
+        return [(row["id"], row["destination"])
+                for row in self.connection.execute("SELECT id, destination FROM books")]
+
+    def apply_reconciliation(self, moved: List[Tuple[int, str]], added: List[dict],
+                             deleted: List[int]) -> None:
+        """ディスクとの差分を1つのトランザクションで反映する
+
+        Args:
+            moved (List[Tuple[int, str]]): 移動した書籍の(id, 新しい移動先)
+            added (List[dict]): title, categories, destinationを持つ、カタログに無かった書籍
+            deleted (List[int]): ファイルが無くなった書籍のid
+        """
+        with self.connection:
+            c = self.connection.cursor()
+            c.executemany(
+                "UPDATE books SET destination = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [(destination, book_id) for book_id, destination in moved])
+            category_ids = {}
+            rows = []
+            for book in added:
+                category = book["categories"]
+                if category is not None and category not in category_ids:
+                    category_ids[category] = self.select_individual_id("categories", category)
+                rows.append((book["title"], category_ids.get(category), book["destination"],
+                             make_key("books", book["title"])))
+            c.executemany(
+                "INSERT INTO books (title, category_id, destination, title_key) VALUES(?, ?, ?, ?)",
+                rows)
+            c.executemany("DELETE FROM books WHERE id = ?", [(book_id, ) for book_id in deleted])
+            c.executemany("DELETE FROM fingerprints WHERE book_id = ?",
+                          [(book_id, ) for book_id in deleted])
+
     def update_dst(self, target: Path, dst: Path) -> None:
-        """isbnや書籍情報が無いものを手作業でアップデートする 
+        """isbnや書籍情報が無いものを手作業でアップデートする
+
+        移動元をdestinationに持つ行だけを書き換え、無ければ新しく加える. 同じ題名の別の本は変えない
 
         Args:
-            target (Path): 対象の本のpath
-            dst (Path): 指定したpath
+            target (Path): 対象の本の移動元のpath
+            dst (Path): 移動先のファイルのpath
         """
         c = self.connection.cursor()
         stem = target.stem
-        query = "INSERT INTO books (title, destination) VALUES(?, ?) WHERE NOT EXISTS (SELECT * FROM books WHERE title = ?)"
-        c.execute(query, (stem, str(dst / target.name), stem))
-        self.connection.commit()
+        key = make_key("books", stem)
+        c.execute(
+            "UPDATE books SET destination = ?, updated_at = CURRENT_TIMESTAMP WHERE destination = ?",
+            (str(dst), str(target)))
+        if c.rowcount == 0:
+            c.execute("INSERT INTO books (title, destination, title_key) VALUES(?, ?, ?)",
+                      (stem, str(dst), key))
+        self._autocommit()
 
 
 if __name__ == "__main__":
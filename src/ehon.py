@@ -1,34 +1,63 @@
 import subprocess
 import time
+from typing import Optional
 
 from bs4 import BeautifulSoup
 from selenium import webdriver
 
 import bookinfo_util
+from metrics import RunMetrics
 
 
 class EhonSearchCliant:
-    def __init__(self) -> None:
+    def __init__(self, metrics: Optional[RunMetrics] = None) -> None:
+        """initialize
+
+        Args:
+            metrics (Optional[RunMetrics], optional): ページ取得時間の記録先
+        """
+        self.metrics = metrics or RunMetrics()
         self.url = "https://www.e-hon.ne.jp/bec/SA/Search"
-        self._driver_path = (subprocess.run(["which", "chromium.chromedriver"],
-                                            encoding="UTF-8",
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE).stdout.rstrip()
-                             or subprocess.run(["which", "chromedriver"],
-                                               encoding="UTF-8",
-                                               stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE).stdout.rstrip())
-        if not self._driver_path:
+        self._driver = None    # Chromeは最初に使うときに起動する
+
+    @property
+    def driver(self) -> webdriver.Chrome:
+        """Chromeのdriver. 初めて参照されたときに起動する
+
+        Raises:
+            NotFoundChromeDriverError: chromedriverが見つからないときのエラー
+        """
+        if self._driver is None:
+            self._driver = self._start_driver()
+        return self._driver
+
+    def _start_driver(self) -> webdriver.Chrome:
+        driver_path = (subprocess.run(["which", "chromium.chromedriver"],
+                                      encoding="UTF-8",
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE).stdout.rstrip()
+                       or subprocess.run(["which", "chromedriver"],
+                                         encoding="UTF-8",
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE).stdout.rstrip())
+        if not driver_path:
             raise NotFoundChromeDriverError(
                 "cannot found chromedriver. please install chromedriver")
 
-        self._options = webdriver.ChromeOptions()
-        self._options.add_argument(
+        options = webdriver.ChromeOptions()
+        options.add_argument(
             "--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.157 Safari/537.36"
         )
-        self._options.add_argument("--headless")
-        self.driver = webdriver.Chrome(options=self._options,
-                                       executable_path=self._driver_path)
+        options.add_argument("--headless")
+        with self.metrics.time("ehon.start"):
+            return webdriver.Chrome(options=options, executable_path=driver_path)
+
+    def close(self) -> None:
+        """Chromeを起動していれば終了する
+        """
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
 
     def fetch_individual_page(self, isbn: str) -> BeautifulSoup:
         """入力されたISBNから個別の書籍ベージのhtmlデータを取得する
@@ -39,11 +68,13 @@ class EhonSearchCliant:
         Returns:
             BeautifulSoup: 個別ページのHTMLを格納したBeautifulSoup
         """
-        self.driver.get(self.url)
-        self.driver.find_element_by_name("isbn").clear()
-        self.driver.find_element_by_name("isbn").send_keys(isbn)
-        self.driver.find_element_by_name("submitLabel").click()
-        time.sleep(2)    # 念の為ページ遷移の時間を確保
+        with self.metrics.time("ehon.request"):
+            self.driver.get(self.url)
+            self.driver.find_element_by_name("isbn").clear()
+            self.driver.find_element_by_name("isbn").send_keys(isbn)
+            self.driver.find_element_by_name("submitLabel").click()
+        with self.metrics.time("ehon.sleep"):
+            time.sleep(2)    # 念の為ページ遷移の時間を確保
         return BeautifulSoup(self.driver.page_source, "html.parser")
 
     def fetch_book_info(self, isbn: str) -> dict:
@@ -97,6 +128,7 @@ class EhonSearchCliant:
             if th == "シリーズ名":
                 series_name = td
         if series_name is None:
+            self.metrics.count("ehon.not_found")
             raise EhonDoesNotHaveDataError(
                 f"e-hon.ne.jp have not get the series information. {isbn=}")
         else:
@@ -0,0 +1,275 @@
+import errno
+import hashlib
+import os
+import shutil
+from contextlib import nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from metrics import RunMetrics
+
+DEFAULT_FILING_CONFIG = {
+    "batch_size": 16,    # 何冊ごとにfsyncと検証をまとめて行うか
+    "verify": "size"    # コピー後の検証方法. "size" or "content"
+}
+
+_COPY_CHUNK = 1 << 26    # copy_file_rangeに一度に渡すバイト数
+
+
+class BookFiler:
+    """書籍をoutput_dirへ移動するクラス
+
+    同じファイルシステム内ならリネーム、別のファイルシステムへはカーネル内コピーで移動する
+    コピーしたファイルはbatch_size冊ごとにfsyncと検証をまとめて行い、それが済むまで元のファイルは消さない
+    移動先に同名のファイルがあるときは"_2", "_3", ...を付けて上書きを避ける
+    """
+    def __init__(self,
+                 batch_size: int = 16,
+                 verify: str = "size",
+                 dry_run: bool = False,
+                 metrics: Optional["RunMetrics"] = None) -> None:
+        """initialize
+
+        Args:
+            batch_size (int, optional): fsyncと検証をまとめて行う冊数
+            verify (str, optional): コピー後の検証方法. "size"ならサイズ、"content"なら中身のハッシュを比べる
+            dry_run (bool, optional): Trueならファイルに触らず移動先の計画だけを作る
+            metrics (Optional[RunMetrics], optional): コピー時間とディレクトリキャッシュのヒット数の記録先
+        """
+        if verify not in {"size", "content"}:
+            raise ValueError(f"unknown verify mode. {verify=}")
+        self.batch_size = batch_size
+        self.verify = verify
+        self.dry_run = dry_run
+        self.metrics = metrics
+        self.plan: List[Tuple[Path, Path]] = []    # (移動元, 移動先)
+        self._created_dirs: Set[Path] = set()
+        self._reserved: Set[Path] = set()    # まだディスクに現れていない移動先
+        # (移動元, 一時ファイル, 移動先, 求められた移動先, 移動を確定したときに呼ぶ関数)
+        self._pending_copies: List[Tuple[Path, Path, Path, Path,
+                                         Optional[Callable[[Path], None]]]] = []
+        self._pending_dirs: Set[Path] = set()    # fsyncが必要なディレクトリ
+        self._n_pending = 0    # 前回のflushから移動した冊数
+
+    def move(self, src: Path, dst: Path,
+             on_publish: Optional[Callable[[Path], None]] = None) -> Path:
+        """srcをdstへ移動する
+
+        Args:
+            src (Path): 移動元のファイル
+            dst (Path): 移動先のファイル
+            on_publish (Optional[Callable[[Path], None]], optional): 移動先の名前でファイルが読めるように
+                なったときに移動先を渡して呼ぶ関数. 別のファイルシステムへのコピーではflushまで遅れる
+
+        Returns:
+            Path: 実際の移動先. 名前が衝突したときはdstと異なる. 別のファイルシステムへのコピーでは
+                flushまでに他のプロセスが同じ名前を使うとさらに変わるので、確定した名前はon_publishで受け取る
+        """
+        src = Path(src)
+        requested = Path(dst)
+        dst = self._resolve_collision(requested)
+        self.plan.append((src, dst))
+        if self.dry_run:
+            return dst
+
+        self._ensure_dir(dst.parent)
+        if self._same_filesystem(src, dst.parent):
+            dst = self._link(src, dst, requested)
+            self._pending_dirs.update([src.parent, dst.parent])
+            if on_publish is not None:
+                on_publish(dst)
+        else:
+            self._copy(src, dst, requested, on_publish)
+        self._n_pending += 1
+        if self._n_pending >= self.batch_size:
+            self.flush()
+        return dst
+
+    def flush(self) -> None:
+        """コピー済みのファイルをfsyncして検証し、移動先の名前にして元のファイルを消す
+
+        失敗した本があっても他の本は確定してから、最初のエラーを投げる
+
+        Raises:
+            FilingVerificationError: コピー後のファイルが元のファイルと一致しなかったときのエラー
+        """
+        with self._time("filing.flush"):
+            self._flush()
+
+    def _flush(self) -> None:
+        pending, self._pending_copies = self._pending_copies, []
+        self._n_pending = 0
+        published = []
+        errors = []
+        for src, part, dst, requested, on_publish in pending:
+            # 1冊ずつ確定し、失敗した本は一時ファイルを消して元のファイルを残す(次の実行でやり直せる)
+            try:
+                _fsync_file(part)
+                if not self._verify(src, part):
+                    raise FilingVerificationError(f"copied file differs from the source. {src=}")
+                dst = self._link(part, dst, requested)
+                self._pending_dirs.add(dst.parent)
+            except Exception as e:
+                _unlink_if_exists(part)
+                self._reserved.discard(dst)
+                errors.append(e)
+                continue
+            published.append((src, dst, on_publish))
+
+        pending_dirs, self._pending_dirs = self._pending_dirs, set()
+        for directory in pending_dirs:
+            fsync_dir(directory)
+        # 移動先が永続化されてから元のファイルを消す. 1冊で失敗しても残りの本の後始末と記録は続ける
+        for src, dst, on_publish in published:
+            try:
+                _unlink_if_exists(src)
+                fsync_dir(src.parent)
+            except Exception as e:
+                errors.append(e)
+            # 元のファイルを消せなくても移動先は確定しているので記録する
+            try:
+                if on_publish is not None:
+                    on_publish(dst)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def _link(self, src: Path, dst: Path, requested: Path) -> Path:
+        """srcをdstの名前にする. 他のプロセス(別のワーカーなど)が先にdstを作っていたら上書きせず、
+        requestedに"_2", "_3", ...を付けた次の空いている名前にする
+
+        Returns:
+            Path: 実際の移動先
+        """
+        while True:
+            try:
+                os.link(src, dst)    # 既存のファイルを上書きしない
+            except FileExistsError:
+                pass
+            except OSError:
+                # ハードリンクが使えないファイルシステム
+                if not dst.exists():
+                    os.rename(src, dst)
+                    break
+            else:
+                src.unlink()
+                break
+            self._count("filing.collision")
+            self._reserved.discard(dst)
+            dst = self._resolve_collision(requested)
+        self._reserved.discard(dst)
+        return dst
+
+    def close(self) -> None:
+        """残っているコピーを確定する
+        """
+        if not self.dry_run:
+            self.flush()
+
+    def _resolve_collision(self, dst: Path) -> Path:
+        """dstが使われていれば"_2", "_3", ...を付けた空いている名前を返す"""
+        candidate = dst
+        n = 1
+        while candidate in self._reserved or candidate.exists():
+            n += 1
+            candidate = dst.with_name(f"{dst.stem}_{n}{dst.suffix}")
+        self._reserved.add(candidate)
+        return candidate
+
+    def _ensure_dir(self, directory: Path) -> None:
+        """作成済みのディレクトリを覚えておき、mkdirを繰り返さない"""
+        if directory in self._created_dirs:
+            self._count("filing.dir_cache.hit")
+            return
+        self._count("filing.dir_cache.miss")
+        directory.mkdir(parents=True, exist_ok=True)
+        self._created_dirs.update([directory, *directory.parents])
+
+    def _same_filesystem(self, src: Path, dst_dir: Path) -> bool:
+        return os.stat(src).st_dev == os.stat(dst_dir).st_dev
+
+    def _copy(self, src: Path, dst: Path, requested: Path,
+              on_publish: Optional[Callable[[Path], None]]) -> None:
+        part = dst.with_name(f".{dst.name}.part")
+        with self._time("filing.copy"):
+            _copy_file(src, part)
+        self._pending_copies.append((src, part, dst, requested, on_publish))
+
+    def _count(self, name: str) -> None:
+        if self.metrics is not None:
+            self.metrics.count(name)
+
+    def _time(self, stage: str):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.time(stage)
+
+    def _verify(self, src: Path, copied: Path) -> bool:
+        if src.stat().st_size != copied.stat().st_size:
+            return False
+        if self.verify == "content":
+            return _digest(src) == _digest(copied)
+        return True
+
+
+def _copy_file(src: Path, dst: Path) -> None:
+    """カーネル内でコピーする. 使えなければ通常のコピーをする
+
+    copy_file_rangeはファイルシステムが対応していればreflinkやサーバ側コピーになる
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            if not hasattr(os, "copy_file_range"):
+                raise OSError(errno.ENOSYS, "copy_file_range is not available")
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), _COPY_CHUNK)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}:
+                raise
+            shutil.copyfileobj(fsrc, fdst, _COPY_CHUNK)
+    shutil.copystat(src, dst)
+
+
+def _unlink_if_exists(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _digest(path: Path) -> str:
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fsync_file(path: Path) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path: Path) -> None:
+    """ディレクトリをfsyncし、中で行った作成、リネーム、削除を永続化する. 対応していなければ何もしない"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return    # ディレクトリをopenできないOS
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass    # ディレクトリのfsyncに対応していないファイルシステム
+    finally:
+        os.close(fd)
+
+
+class FilingVerificationError(Exception):
+    pass
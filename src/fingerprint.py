@@ -0,0 +1,174 @@
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from pipeline import BookJob
+
+DEFAULT_FINGERPRINT_CONFIG = {
+    "enabled": False,    # Trueで表紙の指紋による再スキャンと重複の検出をする
+    "threshold": 3,    # 表紙と裏表紙の64bitの指紋で何bitまでの違いを同じ本とみなすか. 3以下なら索引で探せる
+    "on_match": "reuse",    # "reuse"なら一致した本のISBNを使う、"duplicate"なら重複としてduplicatesに移す
+    "thumbnail_width": 64    # 指紋を取るために描画する表紙と裏表紙の幅(px)
+}
+
+HASH_BITS = 64
+_N_BANDS = 4    # 近傍探索のために指紋を16bitずつに分けて索引を張る
+_BAND_BITS = HASH_BITS // _N_BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+
+def dhash(image) -> int:
+    """画像のdifference hash(64bit)を返す. 再スキャンで画素が変わっても見た目が同じならほぼ同じ値になる
+
+    Args:
+        image (PIL.Image.Image): 画像
+
+    Returns:
+        int: 64bitの指紋
+    """
+    small = image.convert("L").resize((9, 8))
+    pixels = list(small.getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            h = (h << 1) | (left > right)
+    return h
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def to_signed(h: int) -> int:
+    """SQLiteのINTEGER(符号付き64bit)に入るように変換する"""
+    return h - (1 << HASH_BITS) if h >= 1 << (HASH_BITS - 1) else h
+
+
+def to_unsigned(h: int) -> int:
+    return h + (1 << HASH_BITS) if h < 0 else h
+
+
+class FingerprintIndex:
+    """表紙の指紋から近い本を探す索引
+
+    指紋を16bitずつ4つに分け、それぞれの値で本を引けるようにしておく. 違いが3bit以下なら鳩の巣原理で
+    どれか1つは完全に一致するので、その候補だけを比べればよい. それより緩い閾値では全件と比べる
+    複数のスレッドから同時に呼ばれてもよい
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # 移動先 -> (表紙の指紋, 裏表紙の指紋, isbn)
+        self._books: Dict[str, Tuple[int, Optional[int], Optional[str]]] = {}
+        self._bands = [defaultdict(set) for _ in range(_N_BANDS)]
+
+    def __len__(self) -> int:
+        return len(self._books)
+
+    def add(self, destination: str, h: int, isbn: Optional[str],
+            back: Optional[int] = None) -> None:
+        """本を索引に加える. ワーカーとメインのカタログでidが重なるので移動先で区別する
+
+        Args:
+            destination (str): 移動先
+            h (int): 表紙の指紋
+            isbn (Optional[str]): isbn
+            back (Optional[int], optional): 裏表紙の指紋
+        """
+        with self._lock:
+            self._books[destination] = (h, back, isbn)
+            for band, value in zip(self._bands, _split(h)):
+                band[value].add(destination)
+
+    def get(self, destination: str) -> Tuple[int, Optional[int], Optional[str]]:
+        """(表紙の指紋, 裏表紙の指紋, isbn)を返す"""
+        with self._lock:
+            return self._books[destination]
+
+    def nearest(self, h: int, threshold: int) -> Optional[Tuple[str, int]]:
+        """指紋が最も近い本を探す
+
+        Args:
+            h (int): 表紙の指紋
+            threshold (int): 同じ本とみなす最大のbit数の違い
+
+        Returns:
+            Optional[Tuple[str, int]]: (移動先, 違うbit数). threshold以内に無ければNone
+        """
+        found = self.within(h, threshold)
+        return found[0] if found else None
+
+    def within(self, h: int, threshold: int) -> List[Tuple[str, int]]:
+        """表紙の指紋の違いがthreshold以内の本を近い順に返す
+
+        Args:
+            h (int): 表紙の指紋
+            threshold (int): 同じ本とみなす最大のbit数の違い
+
+        Returns:
+            List[Tuple[str, int]]: (移動先, 違うbit数)のリスト. 同じ違いなら移動先の順
+        """
+        with self._lock:
+            if threshold < _N_BANDS:
+                candidates: Set[str] = set()
+                for band, value in zip(self._bands, _split(h)):
+                    candidates |= band.get(value, set())
+            else:
+                candidates = set(self._books)
+            found = []
+            for destination in candidates:
+                distance = hamming(h, self._books[destination][0])
+                if distance <= threshold:
+                    found.append((destination, distance))
+            return sorted(found, key=lambda x: (x[1], x[0]))
+
+
+class FingerprintMatcher:
+    """パイプラインのOCRの前に呼び、表紙の指紋が既存の本と一致すればOCRを飛ばす
+
+    同じシリーズの別の巻は表紙がよく似ているので、裏表紙の指紋も一致したときだけ同じ本とみなす.
+    どちらかの裏表紙の指紋が無ければ一致とはみなさずOCRする
+    """
+    def __init__(self, index: FingerprintIndex, threshold: int = 3,
+                 on_match: str = "reuse") -> None:
+        """initialize
+
+        Args:
+            index (FingerprintIndex): 既存の本の索引
+            threshold (int, optional): 同じ本とみなす最大のbit数の違い. 表紙と裏表紙のそれぞれに使う
+            on_match (str, optional): "reuse"なら一致した本のisbnを使い、"duplicate"なら重複として扱う
+        """
+        if on_match not in {"reuse", "duplicate"}:
+            raise ValueError(f"unknown on_match. {on_match=}")
+        self.index = index
+        self.threshold = threshold
+        self.on_match = on_match
+
+    def __call__(self, job: "BookJob") -> None:
+        """一致する本があればjob.isbnかjob.errorを設定する"""
+        h = job.extras.get("cover_fingerprint")
+        back = job.extras.get("back_fingerprint")
+        if h is None or back is None:
+            return
+        for destination, distance in self.index.within(h, self.threshold):
+            _, known_back, isbn = self.index.get(destination)
+            if known_back is not None and hamming(back, known_back) <= self.threshold:
+                break
+        else:
+            return
+        job.extras["matched_book"] = destination
+        if self.on_match == "reuse" and isbn:
+            job.isbn = isbn
+        else:
+            job.error = DuplicateBookError(
+                f"Same cover as the filed book. {destination=}, {distance=}")
+
+
+def _split(h: int):
+    return [(h >> (i * _BAND_BITS)) & _BAND_MASK for i in range(_N_BANDS)]
+
+
+class DuplicateBookError(Exception):
+    pass
@@ -8,12 +8,21 @@ from bs4 import BeautifulSoup
 from urllib3.exceptions import InsecureRequestWarning
 
 import bookinfo_util
+from metrics import RunMetrics
 
 urllib3.disable_warnings(InsecureRequestWarning)
 
+THROTTLED_STATUS = {429, 503}    # アクセスが多すぎるときにhontoが返すステータス
+
 
 class HontoSearchCliant:
-    def __init__(self) -> None:
+    def __init__(self, metrics: Optional[RunMetrics] = None) -> None:
+        """initialize
+
+        Args:
+            metrics (Optional[RunMetrics], optional): リクエスト時間の記録先
+        """
+        self.metrics = metrics or RunMetrics()
         self.extended_url = "https://honto.jp/netstore/search.html"    # 紙+電子書籍の検索
         self.url = "https://honto.jp/netstore/search_022.html"    # 電子書籍のみ
         self.user_agent = {
@@ -33,10 +42,20 @@ class HontoSearchCliant:
             pass
 
     def _fetch_html(self, page_url: str, **kwargs) -> str:
-        """requestsを短くするためのヘルパ関数"""
-        r = requests.get(url=page_url, headers=self.user_agent, **kwargs,
-                         verify=False).text
-        return r
+        """requestsを短くするためのヘルパ関数
+
+        Raises:
+            HontoThrottledError: hontoがアクセスを制限したときのエラー
+            requests.HTTPError: その他のエラーのステータスが返ったときのエラー
+        """
+        with self.metrics.time("honto.request"):
+            r = requests.get(url=page_url, headers=self.user_agent, **kwargs, verify=False)
+        if r.status_code in THROTTLED_STATUS:
+            # エラーのページを検索結果として読むと「本が無い」になってしまう
+            self.metrics.count("honto.throttled")
+            raise HontoThrottledError(f"Honto is throttling requests. {r.status_code=}, {page_url=}")
+        r.raise_for_status()
+        return r.text
 
     def fetch_individual_page(self, isbn: str) -> BeautifulSoup:
         """入力されたISBNから個別の書籍ベージのhtmlデータを取得する"""
@@ -59,6 +78,7 @@ class HontoSearchCliant:
                                     features="html.parser").find("a", class_="dyTitle")
             # 電子書籍のみでヒットしなければ紙も検索に含める
         if dytitle is None:    #それでもヒットしなければ
+            self.metrics.count("honto.not_found")
             raise HontoDoesNotHaveDataError(f"Honto not have the book data. {isbn=}")
 
         individual_page_url = dytitle.get("href")    # 複数hitは先頭のものを抽出
@@ -158,7 +178,7 @@ class HontoSearchCliant:
         sub_category = self._get_sub_category(soup, category) or ""
 
         info = {
-            "title": bookinfo_util.format_title(book_title),
+            "title": book_title,
             "authors": bookinfo_util.format_authors(authors),
             "publisher": bookinfo_util.format_publisher(publisher),
             "category": category,
@@ -171,6 +191,10 @@ class HontoDoesNotHaveDataError(Exception):
     pass
 
 
+class HontoThrottledError(Exception):
+    pass
+
+
 if __name__ == "__main__":
     cliant = HontoSearchCliant()
     print(cliant.fetch_book_info(isbn="9784047261273"))
@@ -0,0 +1,126 @@
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+# OCRの結果から改行以外の空白と-を除いた文字列に対して使う. 改行は番号の区切りとして残す
+# 後ろに数字が続くものは取らない. 末尾が欠けたISBN-13の先頭10桁をISBN-10と読み違えないように
+_prefixed_pattern = re.compile(
+    r"[Ii][Ss][Bb][Nn](?=(97[89][0-9]{10}(?![0-9])|[0-9]{9}[0-9Xx](?![0-9])))")
+_bare_pattern = re.compile(r"(?=(97[89][0-9]{10}))")    # バーコードの下の数字など
+
+PREFIXED_WEIGHT = 2    # "ISBN"の後ろにある候補
+BARE_WEIGHT = 1
+
+
+def isbn13_check_digit(first12: str) -> str:
+    total = sum(int(d) * (1 + 2 * (i % 2)) for i, d in enumerate(first12))
+    return str((10 - total % 10) % 10)
+
+
+def isbn10_check_digit(first9: str) -> str:
+    total = sum((10 - i) * int(d) for i, d in enumerate(first9))
+    c = (11 - total % 11) % 11
+    return "X" if c == 10 else str(c)
+
+
+def is_valid_isbn13(code: str) -> bool:
+    return (len(code) == 13 and code.isdigit() and code.startswith(("978", "979"))
+            and isbn13_check_digit(code[:12]) == code[12])
+
+
+def is_valid_isbn10(code: str) -> bool:
+    return (len(code) == 10 and code[:9].isdigit()
+            and isbn10_check_digit(code[:9]) == code[9].upper())
+
+
+def to_isbn13(code: str) -> Optional[str]:
+    """ISBNを検証し、13桁にそろえる
+
+    Args:
+        code (str): ISBN. -や空白を含んでいてもよい
+
+    Returns:
+        Optional[str]: 13桁のISBN. チェックディジットが合わなければNone
+    """
+    code = re.sub(r"[\s-]", "", code)
+    if is_valid_isbn13(code):
+        return code
+    if is_valid_isbn10(code):
+        first12 = "978" + code[:9]
+        return first12 + isbn13_check_digit(first12)
+    return None
+
+
+def find_candidates(text: str) -> List[Tuple[str, int]]:
+    """OCRの結果からチェックディジットの合うISBNを探す
+
+    Args:
+        text (str): OCRの結果
+
+    Returns:
+        List[Tuple[str, int]]: (13桁のISBN, 重み)のリスト. "ISBN"の後ろにあるものは重く数える
+    """
+    squeezed = re.sub(r"[^\S\r\n]|-", "", text)
+    candidates = []
+    prefixed_spans = set()
+    for m in _prefixed_pattern.finditer(squeezed):
+        code = to_isbn13(m.group(1))
+        prefixed_spans.add(m.start(1))
+        if code is not None:
+            candidates.append((code, PREFIXED_WEIGHT))
+    for m in _bare_pattern.finditer(squeezed):
+        if m.start(1) in prefixed_spans:
+            continue
+        code = to_isbn13(m.group(1))
+        if code is not None:
+            candidates.append((code, BARE_WEIGHT))
+    return candidates
+
+
+class IsbnVoter:
+    """複数ページのOCRの結果からISBNの候補を集めて多数決をとる
+    """
+    def __init__(self, threshold: int = 3, settle_pages: int = 1) -> None:
+        """initialize
+
+        Args:
+            threshold (int, optional): 1位の候補が2位をこれだけ上回ったら確定とみなす.
+                既定値の3は"ISBN"付きの読み取りとバーコードの数字が一致したとき
+            settle_pages (int, optional): "ISBN"付きで読めた候補が1つだけのまま、さらにこのページ数を
+                読んだら確定とみなす. 奥付にしかISBNが無い本で残りのページを読まないようにする
+        """
+        self.threshold = threshold
+        self.settle_pages = settle_pages
+        self.scores: Counter = Counter()
+        self.n_pages = 0
+        self._order = {}    # 同点なら先に見つかった候補を優先する
+        self._prefixed_at = {}    # 候補が初めて"ISBN"付きで読めたページ
+
+    def add_text(self, text: str) -> None:
+        """1ページ分のOCRの結果を加える"""
+        self.n_pages += 1
+        for code, weight in find_candidates(text):
+            self._order.setdefault(code, len(self._order))
+            self.scores[code] += weight
+            if weight == PREFIXED_WEIGHT:
+                self._prefixed_at.setdefault(code, self.n_pages)
+
+    def ranking(self) -> List[Tuple[str, int]]:
+        return sorted(self.scores.items(), key=lambda kv: (-kv[1], self._order[kv[0]]))
+
+    def best(self) -> Optional[str]:
+        """最も票の多い候補. 候補が無ければNone"""
+        ranking = self.ranking()
+        return ranking[0][0] if ranking else None
+
+    def is_confident(self) -> bool:
+        """これ以上ページを読まなくてよいならTrue"""
+        ranking = self.ranking()
+        if not ranking:
+            return False
+        leader = ranking[0][0]
+        if (len(ranking) == 1 and leader in self._prefixed_at
+                and self.n_pages - self._prefixed_at[leader] >= self.settle_pages):
+            return True
+        runner_up = ranking[1][1] if len(ranking) > 1 else 0
+        return ranking[0][1] - runner_up >= self.threshold
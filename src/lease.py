@@ -0,0 +1,249 @@
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Set, Union
+
+DEFAULT_WORKER_CONFIG = {
+    "lease_seconds": 600,    # 更新されないまま何秒たったら他のワーカーが引き継いでよいか
+    "merge_wait_seconds": 600    # カタログの統合で他のワーカーの統合を待つ最大の秒数
+}
+
+_claimed_pattern = re.compile(r"^(?P<name>.+)\.(?P<owner>[^.]+)\.claimed$")
+
+
+def default_owner() -> str:
+    """ホスト名からワーカー名を作る
+
+    再起動しても同じ名前になるので、止まったワーカーの確保とカタログを次の起動で引き継げる
+    """
+    return re.sub(r"[^0-9A-Za-z-]", "-", socket.gethostname().split(".")[0]) or "worker"
+
+
+def claimed_path(path: Path, owner: str) -> Path:
+    """ownerが確保したときのファイル名. 本.pdf -> 本.pdf.[owner].claimed"""
+    return path.with_name(f"{path.name}.{owner}.claimed")
+
+
+def original_path(path: Path) -> Path:
+    """確保したファイルの元の名前を返す. 確保したファイルでなければそのまま返す"""
+    m = _claimed_pattern.match(path.name)
+    return path.with_name(m.group("name")) if m else path
+
+
+class LeaseManager:
+    """共有のinput_dirにあるpdfを複数のワーカーで分け合うためのリース
+
+    pdfの確保は"本.pdf.[owner].claimed"へのリネームで行う. リネームは不可分なので同じpdfを2つのワーカーが
+    確保することはない. 確保している間はハートビートでファイルの時刻を更新し、ttl秒以上更新されていない
+    確保は止まったワーカーのものとみなして別のワーカーがリネームで引き継ぐ
+    ホスト間の時計はNTPなどで合わせておくこと
+    """
+    def __init__(self, owner: Optional[str] = None, ttl: float = 600) -> None:
+        """initialize
+
+        Args:
+            owner (Optional[str], optional): ワーカー名. "."を含まないこと. 省略時はホスト名
+            ttl (float, optional): リースの有効期限(秒)
+        """
+        self.owner = owner or default_owner()
+        if "." in self.owner:
+            raise ValueError(f"owner must not contain '.'. {self.owner=}")
+        self.ttl = ttl
+        self.held: Set[Path] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+        self._owner_lock: Optional[Path] = None
+
+    def claim(self, path: Path) -> Optional[Path]:
+        """未確保のpdfを確保する
+
+        Args:
+            path (Path): pdfのpath
+
+        Returns:
+            Optional[Path]: 確保したファイルのpath. 他のワーカーが先に確保していたらNone
+        """
+        return self._rename_to_own(path)
+
+    def steal(self, path: Path) -> Optional[Path]:
+        """期限の切れた他のワーカーの確保を引き継ぐ
+
+        Args:
+            path (Path): 他のワーカーが確保したファイルのpath
+
+        Returns:
+            Optional[Path]: 確保したファイルのpath. 期限内か、他のワーカーが先に引き継いでいたらNone
+        """
+        if not self.is_expired(path):
+            return None
+        return self._rename_to_own(path)
+
+    def is_expired(self, path: Path) -> bool:
+        """確保したファイルがttl秒以上更新されていなければTrue
+
+        ctimeはリネームでも更新されるので、確保した直後にmtimeが古くても期限切れとはみなさない
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return time.time() - max(st.st_mtime, st.st_ctime) > self.ttl
+
+    def claims(self, input_dir: Path, pattern: str = "**/*.pdf") -> Iterator[Path]:
+        """input_dirのpdfを1つずつ確保して返す
+
+        未確保のpdfを確保し終えたら、期限の切れた他のワーカーのpdfを引き継ぐ
+        同じワーカー名で前回確保したまま止まったpdfは、exclusiveで他に同じ名前のプロセスが無いと
+        確かめているときだけすぐに引き継ぐ
+
+        Args:
+            input_dir (Path): 共有の入力ディレクトリ
+            pattern (str, optional): 対象のファイルのglob
+
+        Yields:
+            Path: 確保したファイルのpath
+        """
+        for path in sorted(Path(input_dir).glob(pattern)):
+            claimed = self.claim(path)
+            if claimed is not None:
+                yield claimed
+        for path in sorted(Path(input_dir).glob(pattern + ".*.claimed")):
+            if path in self.held:
+                continue
+            if _claimed_pattern.match(path.name).group("owner") == self.owner:
+                if self._owner_lock is None:
+                    continue    # 同じ名前で動いている別のプロセスのものかもしれない
+                claimed = self._rename_to_own(path)
+            else:
+                claimed = self.steal(path)
+            if claimed is not None:
+                yield claimed
+
+    @contextmanager
+    def exclusive(self, target: Path) -> Iterator[Path]:
+        """同じワーカー名のプロセスが他に無いことをtarget.lockで確かめ、withの間持ち続ける
+
+        lockの時刻はrenewで更新する. 止まったワーカーのlockはttl秒たつと取り直せる
+
+        Args:
+            target (Path): ワーカーごとのカタログなど、同じワーカー名で共有してはいけないファイル
+
+        Raises:
+            TimeoutError: 同じワーカー名のプロセスが動いているか、止まってからttl秒たっていないときのエラー
+        """
+        with exclusive_lock(target, stale_seconds=self.ttl, wait_seconds=0) as lock:
+            self._owner_lock = lock
+            try:
+                yield lock
+            finally:
+                self._owner_lock = None
+
+    def renew(self) -> None:
+        """確保しているファイルとexclusiveのlockの時刻を更新する. 他のワーカーに引き継がれたものは手放す
+        """
+        with self._lock:
+            held = list(self.held)
+        if self._owner_lock is not None:
+            os.utime(self._owner_lock)
+        for path in held:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                with self._lock:
+                    self.held.discard(path)
+
+    def release(self, path: Path) -> None:
+        """処理を終えて移動したファイルを手放す
+
+        Args:
+            path (Path): 確保したファイルのpath
+        """
+        with self._lock:
+            self.held.discard(path)
+
+    def abandon_all(self) -> None:
+        """処理しないまま確保しているファイルを元の名前に戻す
+        """
+        with self._lock:
+            held, self.held = self.held, set()
+        for path in held:
+            try:
+                os.rename(path, original_path(path))
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def heartbeat(self) -> Iterator["LeaseManager"]:
+        """withの間ttlの1/3ごとにrenewし、抜けるときに処理しなかったファイルを元に戻す
+        """
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        try:
+            yield self
+        finally:
+            self._stop.set()
+            self._heartbeat.join()
+            self.abandon_all()
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            self.renew()
+
+    def _rename_to_own(self, path: Path) -> Optional[Path]:
+        claimed = claimed_path(original_path(path), self.owner)
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None    # 他のワーカーが先にリネームした
+        os.utime(claimed)
+        with self._lock:
+            self.held.add(claimed)
+        return claimed
+
+
+@contextmanager
+def exclusive_lock(target: Union[str, Path], stale_seconds: float = 600,
+                   wait_seconds: float = 600) -> Iterator[Path]:
+    """target.lockを排他的に作り、withを抜けるときに消す
+
+    ネットワーク越しのファイルシステムでも動くようにO_EXCLで作る. stale_seconds以上古いlockは壊れたものとみなす
+
+    Args:
+        target (Union[str, Path]): 守りたいファイル
+        stale_seconds (float, optional): 古いlockを消すまでの秒数
+        wait_seconds (float, optional): lockを待つ最大の秒数
+
+    Raises:
+        TimeoutError: wait_seconds待ってもlockを取れなかったときのエラー
+    """
+    lock = Path(f"{target}.lock")
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock).st_mtime > stale_seconds:
+                    os.unlink(lock)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"cannot acquire lock. {lock=}")
+            time.sleep(0.1)
+    try:
+        os.write(fd, default_owner().encode())
+        os.close(fd)
+        yield lock
+    finally:
+        try:
+            os.unlink(lock)
+        except FileNotFoundError:
+            pass
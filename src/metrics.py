@@ -0,0 +1,209 @@
+import cProfile
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class RunMetrics:
+    """ステージごとの処理時間とカウンタを集めてJSON Linesで書き出すクラス
+
+    複数のスレッドから同時に呼ばれてもよい
+    """
+    def __init__(self, path: Optional[Path] = None) -> None:
+        """initialize
+
+        Args:
+            path (Optional[Path], optional): JSON Linesの書き出し先. Noneならメモリ上で集計だけする
+        """
+        self._lock = threading.Lock()
+        self._fp = open(path, "a", buffering=1) if path is not None else None
+        self._started = time.monotonic()
+        self.timings: Dict[str, List[float]] = defaultdict(list)    # ステージ -> 秒のリスト
+        self.book_seconds: Dict[str, float] = defaultdict(float)    # 本 -> 全ステージの合計秒
+        self.counters: Counter = Counter()
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    @contextmanager
+    def time(self, stage: str, book: Optional[Any] = None) -> Iterator[None]:
+        """withの中の処理時間をstageの時間として記録する
+
+        Args:
+            stage (str): ステージ名. "honto.request"のように.で区切る
+            book (Optional[Any], optional): 対象の本. 本ごとの集計に使う
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, book)
+
+    def record(self, stage: str, seconds: float, book: Optional[Any] = None) -> None:
+        """処理時間を記録する
+
+        Args:
+            stage (str): ステージ名
+            seconds (float): 処理時間
+            book (Optional[Any], optional): 対象の本
+        """
+        with self._lock:
+            self.timings[stage].append(seconds)
+            if book is not None:
+                self.book_seconds[str(book)] += seconds
+            self._write({"event": "timing", "stage": stage, "seconds": round(seconds, 6),
+                         "book": None if book is None else str(book)})
+
+    def count(self, name: str, n: int = 1) -> None:
+        """カウンタを増やす. キャッシュのヒットやエラーの数に使う
+
+        Args:
+            name (str): カウンタ名
+            n (int, optional): 増やす数
+        """
+        with self._lock:
+            self.counters[name] += n
+
+    def timings_since(self, stage: str, offset: int) -> List[float]:
+        """stageのoffset番目以降の処理時間を返す. 実行中の集計に使う
+
+        Args:
+            stage (str): ステージ名
+            offset (int): 前回までに読んだ数
+
+        Returns:
+            List[float]: 処理時間のリスト
+        """
+        with self._lock:
+            return self.timings[stage][offset:]
+
+    def counts(self) -> Dict[str, int]:
+        """カウンタの写しを返す. 実行中に他のスレッドから読むときに使う"""
+        with self._lock:
+            return dict(self.counters)
+
+    def event(self, kind: str, **fields: Any) -> None:
+        """処理時間やカウンタ以外の出来事を書き出す
+
+        Args:
+            kind (str): 出来事の種類
+        """
+        with self._lock:
+            self._write({"event": kind, **fields})
+
+    def summary(self, n_slowest: int = 5) -> dict:
+        """ステージごとのp50/p95、1分あたりの冊数、遅かった本をまとめる
+
+        Args:
+            n_slowest (int, optional): 遅かった本をいくつ出すか
+
+        Returns:
+            dict: 集計結果
+        """
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            stages = {
+                stage: {
+                    "count": len(seconds),
+                    "total": round(sum(seconds), 3),
+                    "p50": round(percentile(seconds, 50), 3),
+                    "p95": round(percentile(seconds, 95), 3)
+                }
+                for stage, seconds in sorted(self.timings.items())
+            }
+            slowest = sorted(self.book_seconds.items(), key=lambda kv: kv[1],
+                             reverse=True)[:n_slowest]
+            return {
+                "elapsed": round(elapsed, 3),
+                "books": self.counters["books"],
+                "books_per_minute": round(self.counters["books"] / elapsed * 60, 2)
+                if elapsed > 0 else 0.0,
+                "stages": stages,
+                "counters": dict(self.counters),
+                "slowest_books": [{"book": b, "seconds": round(s, 3)} for b, s in slowest]
+            }
+
+    def write_summary(self) -> dict:
+        """集計結果を書き出し、表示する
+
+        Returns:
+            dict: 集計結果
+        """
+        result = self.summary()
+        with self._lock:
+            self._write({"event": "summary", **result})
+        print(format_summary(result))
+        return result
+
+    def _write(self, row: dict) -> None:
+        if self._fp is not None:
+            print(json.dumps({"ts": time.time(), **row}, ensure_ascii=False), file=self._fp)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近傍順位法でパーセンタイルを求める
+
+    Args:
+        values (List[float]): 値のリスト
+        p (float): 0 - 100
+
+    Returns:
+        float: パーセンタイル. 空なら0
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))    # ceil
+    return ordered[int(rank) - 1]
+
+
+def format_summary(result: dict) -> str:
+    """summary()の結果を表示用の文字列にする"""
+    lines = [f"books: {result['books']} ({result['books_per_minute']} books/min, "
+             f"{result['elapsed']}s)"]
+    for stage, s in result["stages"].items():
+        lines.append(f"\t{stage}: n={s['count']} p50={s['p50']}s p95={s['p95']}s "
+                     f"total={s['total']}s")
+    for name, n in sorted(result["counters"].items()):
+        lines.append(f"\t{name}: {n}")
+    for book in result["slowest_books"]:
+        lines.append(f"\tslow: {book['seconds']}s {book['book']}")
+    return "\n".join(lines)
+
+
+def profile_call(func: Callable, *args, output: Optional[Path] = None, n_lines: int = 20):
+    """cProfileとtracemallocを有効にしてfuncを1回呼び、結果を表示する
+
+    Args:
+        func (Callable): 対象の関数
+        output (Optional[Path], optional): pstatsの書き出し先
+        n_lines (int, optional): 表示する行数
+
+    Returns:
+        Any: funcの返り値
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(func, *args)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    stats = pstats.Stats(profiler).sort_stats("cumulative")
+    stats.print_stats(n_lines)
+    if output is not None:
+        stats.dump_stats(output)
+    print(f"peak memory: {peak / 2**20:.1f} MiB")
+    for stat in snapshot.statistics("lineno")[:n_lines]:
+        print(f"\t{stat}")
+    return result
@@ -1,3 +1,4 @@
+import threading
 from datetime import datetime
 from pathlib import Path
 from typing import Union
@@ -12,6 +13,7 @@ class MyLogger:
         logger_path = Path(__file__).resolve().parents[1] / "book_db.log"
         logger_path.touch()
         self.fp = open(logger_path, "a")
+        self._lock = threading.Lock()    # 自動調整のスレッドからも書く
 
     def __del__(self):
         """closeは忘れずにする
@@ -26,4 +28,5 @@ class MyLogger:
             operand (Union[Path, str]): SUCCESSなら移動先のパス文字列, ERRORならどこでのエラーなのか
         """
         row = "\t".join([datetime.now().strftime("%Y-%m-%d %R"), status, str(operand)])
-        print(row, file=self.fp)
+        with self._lock:
+            print(row, file=self.fp)
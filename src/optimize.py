@@ -0,0 +1,225 @@
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Sequence
+
+import PyPDF2
+
+from filing import fsync_dir
+
+if TYPE_CHECKING:
+    from metrics import RunMetrics
+
+DEFAULT_OPTIMIZE_CONFIG = {
+    "enabled": False,    # Trueで移動したpdfを裏で最適化する
+    "workers": 1,    # 最適化を行うプロセス数
+    "recompress": True,    # Ghostscriptで画像を再圧縮する
+    "image_dpi": 200,    # カラーとグレーの画像をこのdpiまで落としてJPEGにする
+    "mono_dpi": 400,    # 白黒の画像をこのdpiまで落としてCCITT G4にする
+    "linearize": True    # qpdfで1ページ目から表示できるように並べ替える
+}
+
+
+@dataclass
+class OptimizeResult:
+    """1冊分の最適化の結果. 小さくならなかったときはoptimized_sizeがoriginal_sizeと同じ"""
+    path: Path
+    original_size: int
+    optimized_size: int
+    seconds: float
+
+
+def build_commands(recompress: bool = True,
+                   image_dpi: int = 200,
+                   mono_dpi: int = 400,
+                   linearize: bool = True) -> List[List[str]]:
+    """インストールされている外部コマンドから最適化の手順を作る
+
+    各コマンドの"{input}"と"{output}"は実行時にファイル名に置き換える
+
+    Args:
+        recompress (bool, optional): Ghostscript(gs)で画像を再圧縮する
+        image_dpi (int, optional): カラーとグレーの画像の上限のdpi
+        mono_dpi (int, optional): 白黒の画像の上限のdpi
+        linearize (bool, optional): qpdfで線形化する
+
+    Returns:
+        List[List[str]]: 順に実行するコマンド. 使えるコマンドが無ければ空
+    """
+    commands = []
+    gs = shutil.which("gs")
+    if recompress and gs is not None:
+        commands.append([
+            gs, "-sDEVICE=pdfwrite", "-dNOPAUSE", "-dBATCH", "-dQUIET", "-dSAFER",
+            "-dDownsampleColorImages=true", f"-dColorImageResolution={image_dpi}",
+            "-dAutoFilterColorImages=false", "-dColorImageFilter=/DCTEncode",
+            "-dDownsampleGrayImages=true", f"-dGrayImageResolution={image_dpi}",
+            "-dAutoFilterGrayImages=false", "-dGrayImageFilter=/DCTEncode",
+            "-dDownsampleMonoImages=true", f"-dMonoImageResolution={mono_dpi}",
+            "-dMonoImageFilter=/CCITTFaxEncode", "-sOutputFile={output}", "{input}"
+        ])
+    qpdf = shutil.which("qpdf")
+    if linearize and qpdf is not None:
+        commands.append([
+            qpdf, "--linearize", "--object-streams=generate", "--warning-exit-0", "{input}",
+            "{output}"
+        ])
+    return commands
+
+
+def optimize_pdf(path: Path, commands: Sequence[Sequence[str]]) -> OptimizeResult:
+    """pdfを最適化し、小さくなったときだけ置き換える. プロセスプールで実行する
+
+    同じディレクトリの隠しファイルに書き出してから置き換えるので、途中で止まっても元のファイルは壊れない
+    最適化している間に元のファイルが変わったときも置き換えない
+    元のファイルが唯一の控えなので、最適化したものがpdfとして読めてページ数が同じときだけ置き換える
+
+    Args:
+        path (Path): pdfのpath
+        commands (Sequence[Sequence[str]]): build_commandsで作ったコマンド
+
+    Raises:
+        OptimizeError: コマンドが失敗したか、pdfでないものやページ数の違うものを出力したときのエラー
+
+    Returns:
+        OptimizeResult: 最適化の結果
+    """
+    start = time.perf_counter()
+    path = Path(path)
+    before = os.stat(path)
+    current = path
+    outputs = []
+    try:
+        for i, command in enumerate(commands):
+            output = path.with_name(f".{path.name}.opt{i}")
+            outputs.append(output)
+            args = [arg.format(input=current, output=output) for arg in command]
+            completed = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if completed.returncode != 0:
+                raise OptimizeError(
+                    f"{Path(command[0]).name} failed. {path=}, {completed.stderr[-500:]!r}")
+            current = output
+
+        optimized_size = current.stat().st_size if outputs else before.st_size
+        if current == path or optimized_size >= before.st_size:
+            return OptimizeResult(path, before.st_size, before.st_size,
+                                  time.perf_counter() - start)
+        with open(current, "rb") as f:
+            if f.read(5) != b"%PDF-":
+                raise OptimizeError(f"optimized file is not a pdf. {path=}")
+            os.fsync(f.fileno())
+        n_pages = count_pages(path)
+        n_optimized_pages = count_pages(current)
+        if n_optimized_pages != n_pages:
+            # 途中で切れたものやページを落としたもの
+            raise OptimizeError(f"page count changed. {path=}, {n_pages=}, {n_optimized_pages=}")
+        shutil.copystat(path, current)
+        after = os.stat(path)
+        if (after.st_ino, after.st_size, after.st_mtime_ns) != (before.st_ino, before.st_size,
+                                                                 before.st_mtime_ns):
+            # 最適化している間に移動や書き換えがあった
+            return OptimizeResult(path, before.st_size, before.st_size,
+                                  time.perf_counter() - start)
+        os.replace(current, path)
+        fsync_dir(path.parent)
+        return OptimizeResult(path, before.st_size, optimized_size, time.perf_counter() - start)
+    finally:
+        for output in outputs:
+            try:
+                output.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def count_pages(path: Path) -> int:
+    """pdfのページ数を返す
+
+    Raises:
+        OptimizeError: pdfとして読めなかったときのエラー
+    """
+    try:
+        with open(path, "rb") as f:
+            return PyPDF2.PdfFileReader(f, strict=False).getNumPages()
+    except Exception as e:
+        raise OptimizeError(f"cannot read the pdf. {path=}, {type(e).__name__}: {e}") from e
+
+
+class PdfOptimizer:
+    """移動したpdfを裏のプロセスプールで最適化する
+
+    submitはすぐに返るのでファイリングを遅らせない. 結果はdrainで呼び出し元のスレッドに取り出し、
+    データベースへの書き込みはそのスレッドで行う
+    """
+    def __init__(self,
+                 commands: Sequence[Sequence[str]],
+                 workers: int = 1,
+                 metrics: Optional["RunMetrics"] = None) -> None:
+        """initialize
+
+        Args:
+            commands (Sequence[Sequence[str]]): build_commandsで作ったコマンド
+            workers (int, optional): 最適化を行うプロセス数
+            metrics (Optional[RunMetrics], optional): 最適化の時間と削減量の記録先
+        """
+        if workers < 1:
+            raise ValueError(f"worker count must be positive. {workers=}")
+        self.commands = [list(command) for command in commands]
+        self.metrics = metrics
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._futures: List[Future] = []
+
+    def submit(self, path: Path) -> None:
+        """pdfの最適化を予約する
+
+        Args:
+            path (Path): 移動を終えたpdfのpath
+        """
+        self._futures.append(self._executor.submit(optimize_pdf, Path(path), self.commands))
+
+    def drain(self, wait: bool = False) -> List[OptimizeResult]:
+        """終わった最適化の結果を取り出す. 失敗したものはエラー数だけを記録して捨てる
+
+        Args:
+            wait (bool, optional): Trueなら予約したものがすべて終わるまで待つ
+
+        Returns:
+            List[OptimizeResult]: 終わった最適化の結果
+        """
+        results = []
+        remaining = []
+        for future in self._futures:
+            if not wait and not future.done():
+                remaining.append(future)
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.count(f"error.optimize.{type(e).__name__}")
+                continue
+            if self.metrics is not None:
+                self.metrics.record("optimize", result.seconds)
+                self.metrics.count("optimize.saved_bytes",
+                                   result.original_size - result.optimized_size)
+            results.append(result)
+        self._futures = remaining
+        return results
+
+    def close(self) -> List[OptimizeResult]:
+        """予約したものがすべて終わるのを待ってプールを閉じる
+
+        Returns:
+            List[OptimizeResult]: まだ取り出していなかった結果
+        """
+        try:
+            return self.drain(wait=True)
+        finally:
+            self._executor.shutdown()
+
+
+class OptimizeError(Exception):
+    pass
@@ -0,0 +1,398 @@
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from contextlib import nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from metrics import RunMetrics
+
+DEFAULT_PIPELINE_CONFIG = {
+    "ocr_workers": 2,    # OCRを行うプロセス数
+    "lookup_workers": 2,    # 書籍情報を取得するスレッド数(e-honはスレッドごとにChromeを1つ起動する)
+    "queue_size": 8    # ステージ間のキューの上限(これを超えると前段が待つ)
+}
+
+_STOP = object()    # 各ステージに終了を伝える番兵
+
+
+@dataclass
+class BookJob:
+    """パイプラインを流れる1冊分の作業単位
+
+    isbnが指定されていればOCRを、infoかdstかerrorが指定されていれば書籍情報の取得も飛ばす
+    extrasには表紙の指紋などステージが書籍について見つけた追加の情報を入れる
+    """
+    path: Path
+    isbn: Optional[str] = None
+    info: Optional[dict] = None
+    dst: Optional[Path] = None
+    error: Optional[Exception] = None
+    extras: dict = field(default_factory=dict)
+
+
+class LookupMemo:
+    """同じisbnの書籍情報の取得を1回にまとめる
+
+    取得中の isbn を別のスレッドが求めたときは、その取得が終わるのを待って同じ結果を返す
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._results: Dict[str, Future] = {}
+
+    def get(self, isbn: str, lookup: Callable[[str], dict]) -> Tuple[dict, bool]:
+        """isbnの書籍情報を返す. 取得に失敗していればそのときの例外を投げる
+
+        Args:
+            isbn (str): isbn
+            lookup (Callable[[str], dict]): まだ取得していないときに使う関数
+
+        Returns:
+            Tuple[dict, bool]: 書籍情報と、すでに取得済みだったかどうか
+        """
+        with self._lock:
+            future = self._results.get(isbn)
+            hit = future is not None
+            if not hit:
+                future = self._results[isbn] = Future()
+        if not hit:
+            try:
+                future.set_result(lookup(isbn))
+            except Exception as e:
+                future.set_exception(e)
+        return dict(future.result()), hit
+
+
+class BookPipeline:
+    """OCR -> 書籍情報の取得 -> ファイリングを重ねて実行するパイプライン
+
+    OCRはプロセスプール、書籍情報の取得はスレッド、ファイリングは呼び出し元のスレッド1つで行う
+    ステージ間は上限付きのキューでつなぎ、後段が詰まったら前段が待つ
+    同じisbnの書籍情報は1回の実行につき1度だけ取得する
+    OCRと取得の並列数はocr_limitとlookup_limitで実行中に下げたり戻したりできる
+    """
+    def __init__(self,
+                 scan: Callable[[Path], str],
+                 lookup_factory: Callable[[], Callable[[str], dict]],
+                 ocr_workers: int = 2,
+                 lookup_workers: int = 2,
+                 queue_size: int = 8,
+                 metrics: Optional["RunMetrics"] = None,
+                 fingerprint: Optional[Callable[[Path], dict]] = None,
+                 match: Optional[Callable[[BookJob], None]] = None) -> None:
+        """initialize
+
+        Args:
+            scan (Callable[[Path], str]): pdfからisbnを返す関数. プロセスプールで実行するのでpickleできること.
+                (isbn, {内訳: 秒})を返せば内訳を"ocr.内訳"の時間として記録する.
+                (isbn, {内訳: 秒}, {追加の情報})を返せば追加の情報をjob.extrasに入れる
+            lookup_factory (Callable[[], Callable[[str], dict]]): isbnから書籍情報を返す関数を作る関数.
+                取得スレッドごとに1回呼ぶ. 返り値がcloseを持っていれば終了時に呼ぶ
+            ocr_workers (int, optional): OCRのプロセス数. ocr_limitで変えられる並列数の最大
+            lookup_workers (int, optional): 書籍情報取得のスレッド数. lookup_limitで変えられる並列数の最大
+            queue_size (int, optional): ステージ間のキューの上限
+            metrics (Optional[RunMetrics], optional): ステージごとの時間とエラー数の記録先
+            fingerprint (Optional[Callable[[Path], dict]], optional): OCRの前にプロセスプールで実行し、
+                返り値をjob.extrasに入れる関数. pickleできること. 失敗してもOCRは続ける
+            match (Optional[Callable[[BookJob], None]], optional): fingerprintの後にOCRのスレッドで呼ぶ関数.
+                job.isbnかjob.errorを設定すればOCRを飛ばす. 複数のスレッドから同時に呼ばれる
+        """
+        if ocr_workers < 1 or lookup_workers < 1:
+            raise ValueError(f"worker count must be positive. {ocr_workers=}, {lookup_workers=}")
+        self.scan = scan
+        self.lookup_factory = lookup_factory
+        self.ocr_workers = ocr_workers
+        self.lookup_workers = lookup_workers
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.fingerprint = fingerprint
+        self.match = match
+        self.ocr_limit = ConcurrencyLimit(ocr_workers)
+        self.lookup_limit = ConcurrencyLimit(lookup_workers)
+        self._queues: Dict[str, queue.Queue] = {}
+
+    def run(self, jobs: Iterable[BookJob], file: Callable[[BookJob], None]) -> None:
+        """jobsをすべて処理する
+
+        fileは呼び出し元のスレッドで1冊ずつ呼ばれる. 前段で起きた例外はjob.errorに入れて渡す
+        fileが例外を投げたら残りのジョブを捨てて例外をそのまま投げる
+
+        Args:
+            jobs (Iterable[BookJob]): 処理するジョブ. 必要になった分だけ読み出す
+            file (Callable[[BookJob], None]): 書籍を移動しデータベースに書き込む関数
+        """
+        self._abort = threading.Event()
+        self._ocr_queue = queue.Queue(self.queue_size)
+        self._lookup_queue = queue.Queue(self.queue_size)
+        self._file_queue = queue.Queue(self.queue_size)
+        self._queues = {
+            "ocr": self._ocr_queue,
+            "lookup": self._lookup_queue,
+            "file": self._file_queue
+        }
+        self._remaining = {"ocr": self.ocr_workers, "lookup": self.lookup_workers}
+        self._remaining_lock = threading.Lock()
+        self._feed_error = None
+        self._memo = LookupMemo()
+        self.ocr_limit.reopen()
+        self.lookup_limit.reopen()
+
+        with ProcessPoolExecutor(max_workers=self.ocr_workers) as executor:
+            threads = [threading.Thread(target=self._feed, args=(jobs, ), daemon=True)]
+            threads += [
+                threading.Thread(target=self._ocr_worker, args=(executor, slot), daemon=True)
+                for slot in range(self.ocr_workers)
+            ]
+            threads += [
+                threading.Thread(target=self._lookup_worker, args=(slot, ), daemon=True)
+                for slot in range(self.lookup_workers)
+            ]
+            for thread in threads:
+                thread.start()
+
+            try:
+                while True:
+                    job = self._get(self._file_queue)
+                    if job is _STOP:
+                        break
+                    with self._time("filing", job):
+                        file(job)
+            except BaseException:
+                self._abort.set()
+                raise
+            finally:
+                for thread in threads:
+                    thread.join()
+                self._queues = {}
+        if self._feed_error is not None:
+            raise self._feed_error
+
+    def queue_depths(self) -> Dict[str, int]:
+        """各ステージの処理待ちの数. 実行中でなければ空"""
+        return {stage: q.qsize() for stage, q in self._queues.items()}
+
+    def _time(self, stage: str, job: BookJob):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.time(stage, job.path.name)
+
+    def _count_error(self, stage: str, e: Exception) -> None:
+        if self.metrics is not None:
+            self.metrics.count(f"error.{stage}.{type(e).__name__}")
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """中断されない限りキューに入れる(空きが出るまで待つ)"""
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        """中断されない限りキューから取り出す. 中断されたら番兵を返す"""
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _take(self, q: queue.Queue, limit: "ConcurrencyLimit", slot: int):
+        """slotが有効な間だけキューから取り出す. 無効になったらNone、中断されたら番兵を返す"""
+        while not self._abort.is_set():
+            if not limit.is_active(slot):
+                return None
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _stop_stage(self, q: queue.Queue, limit: "ConcurrencyLimit") -> None:
+        """番兵を受け取ったワーカーが、休んでいるワーカーも含めてステージを止める"""
+        limit.close()
+        self._put(q, _STOP)    # 同じステージの他のワーカーにも伝える
+
+    def _finish_stage(self, stage: str, next_queue: queue.Queue) -> None:
+        """ステージの最後のワーカーが抜けるときに後段へ番兵を送る"""
+        with self._remaining_lock:
+            self._remaining[stage] -= 1
+            is_last = self._remaining[stage] == 0
+        if is_last:
+            self._put(next_queue, _STOP)
+
+    def _feed(self, jobs: Iterable[BookJob]) -> None:
+        """ジョブを必要なステージに振り分ける"""
+        try:
+            for job in jobs:
+                if job.info is not None or job.dst is not None or job.error is not None:
+                    next_queue = self._file_queue
+                elif job.isbn is not None:
+                    next_queue = self._lookup_queue
+                else:
+                    next_queue = self._ocr_queue
+                if not self._put(next_queue, job):
+                    return
+        except Exception as e:
+            # 入力を読めなくなったらそれまでのジョブだけ処理し、run()の最後に投げ直す
+            self._feed_error = e
+        finally:
+            self._put(self._ocr_queue, _STOP)
+
+    def _ocr_worker(self, executor: ProcessPoolExecutor, slot: int) -> None:
+        while self.ocr_limit.wait_active(slot, self._abort):
+            job = self._take(self._ocr_queue, self.ocr_limit, slot)
+            if job is None:
+                continue
+            if job is _STOP:
+                self._stop_stage(self._ocr_queue, self.ocr_limit)
+                break
+            if self.fingerprint is not None and self._shortcut(executor, job):
+                continue
+            try:
+                with self._time("ocr", job):
+                    result = executor.submit(self.scan, job.path).result()
+            except Exception as e:
+                self._count_error("ocr", e)
+                job.error = e
+                self._put(self._file_queue, job)
+            else:
+                if isinstance(result, tuple):
+                    result, breakdown, *extras = result
+                    for name, seconds in breakdown.items():
+                        if self.metrics is not None:
+                            self.metrics.record(f"ocr.{name}", seconds)
+                    for extra in extras:
+                        job.extras.update(extra)
+                job.isbn = result
+                self._put(self._lookup_queue, job)
+        self._finish_stage("ocr", self._lookup_queue)
+
+    def _shortcut(self, executor: ProcessPoolExecutor, job: BookJob) -> bool:
+        """fingerprintとmatchでOCRを飛ばせたら後段に流してTrueを返す"""
+        try:
+            with self._time("fingerprint", job):
+                job.extras.update(executor.submit(self.fingerprint, job.path).result())
+            if self.match is not None:
+                self.match(job)
+        except Exception as e:
+            self._count_error("fingerprint", e)
+            return False
+        if job.error is not None:
+            next_queue = self._file_queue
+        elif job.isbn is not None:
+            next_queue = self._lookup_queue
+        else:
+            return False
+        if self.metrics is not None:
+            self.metrics.count("fingerprint.match")
+        self._put(next_queue, job)
+        return True
+
+    def _lookup_worker(self, slot: int) -> None:
+        lookup = None
+        broken = None    # クライアントを作れなかったときは以降のジョブをすべてエラーとして流す
+        try:
+            while self.lookup_limit.wait_active(slot, self._abort):
+                if lookup is None and broken is None:
+                    try:
+                        lookup = self.lookup_factory()
+                    except Exception as e:
+                        broken = e
+                job = self._take(self._lookup_queue, self.lookup_limit, slot)
+                if job is None:
+                    # 休む間はクライアント(e-honのChrome)を閉じてメモリを返す
+                    _close(lookup)
+                    lookup = None
+                    continue
+                if job is _STOP:
+                    self._stop_stage(self._lookup_queue, self.lookup_limit)
+                    break
+                if broken is not None:
+                    job.error = broken
+                else:
+                    try:
+                        with self._time("lookup", job):
+                            job.info, hit = self._memo.get(job.isbn, lookup)
+                        if self.metrics is not None:
+                            self.metrics.count("lookup.cache.hit" if hit else "lookup.cache.miss")
+                    except Exception as e:
+                        self._count_error("lookup", e)
+                        job.error = e
+                self._put(self._file_queue, job)
+        finally:
+            _close(lookup)
+            self._finish_stage("lookup", self._file_queue)
+
+
+class ConcurrencyLimit:
+    """ステージで同時に動くワーカーの数の上限. 実行中に変えられる
+
+    ワーカーには0から番号を振り、番号が上限未満のワーカーだけがジョブを取る
+    上限を下げると、番号の大きいワーカーは今のジョブを終えてから休む
+    """
+    def __init__(self, maximum: int, limit: Optional[int] = None) -> None:
+        """initialize
+
+        Args:
+            maximum (int): ワーカーの数. 上限はこれを超えない
+            limit (Optional[int], optional): 最初の上限. 省略時はmaximum
+        """
+        self.maximum = maximum
+        self._cond = threading.Condition()
+        self._limit = maximum
+        self._closed = False
+        if limit is not None:
+            self.set(limit)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def set(self, limit: int) -> int:
+        """上限を変える
+
+        Args:
+            limit (int): 新しい上限. 1からmaximumの間に丸める
+
+        Returns:
+            int: 丸めた後の上限
+        """
+        with self._cond:
+            self._limit = max(1, min(self.maximum, limit))
+            self._cond.notify_all()
+            return self._limit
+
+    def is_active(self, slot: int) -> bool:
+        return slot < self._limit
+
+    def wait_active(self, slot: int, abort: threading.Event) -> bool:
+        """slotが有効になるまで待つ
+
+        Returns:
+            bool: ジョブを取ってよければTrue. ステージが終わったか中断されたらFalse
+        """
+        with self._cond:
+            while slot >= self._limit and not self._closed and not abort.is_set():
+                self._cond.wait(0.1)
+            return not self._closed and not abort.is_set()
+
+    def close(self) -> None:
+        """休んでいるワーカーも含めてステージを終わらせる"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reopen(self) -> None:
+        with self._cond:
+            self._closed = False
+
+
+def _close(lookup) -> None:
+    close = getattr(lookup, "close", None)
+    if close is not None:
+        close()
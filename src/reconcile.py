@@ -0,0 +1,228 @@
+import os
+from argparse import ArgumentParser, Namespace
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+import yaml
+
+import bookinfo_util
+from databese import DatabaseCliant
+
+MAX_DELETE_FRACTION = 0.5    # --forceが無ければ、カタログのこの割合を超えて消すときは止める
+
+
+@dataclass
+class ReconcilePlan:
+    """カタログとoutput_dirの差分"""
+    moved: List[Tuple[int, str]] = field(default_factory=list)    # (書籍のid, 新しい移動先)
+    added: List[str] = field(default_factory=list)    # カタログに無いファイル
+    deleted: List[int] = field(default_factory=list)    # ファイルが無くなった書籍のid
+    n_unchanged: int = 0
+
+
+def scan_output_dir(output_dir: Path, n_workers: int = 8) -> Set[str]:
+    """output_dir以下のpdfを並列に列挙する. エラー置き場のtmpとduplicates、書きかけの.partは除く
+
+    Args:
+        output_dir (Path): 出力先のディレクトリ
+        n_workers (int, optional): 並列に走査するスレッド数
+
+    Returns:
+        Set[str]: pdfの絶対パスの集合
+    """
+    output_dir = Path(output_dir).absolute()
+    found = set()
+    roots = []
+    # カテゴリ/小分類の単位で分けて走査する
+    for category in os.scandir(output_dir):
+        if category.name in {"tmp", "duplicates"}:
+            continue
+        if category.is_file():
+            found.add(category.path)
+        elif category.is_dir():
+            for entry in os.scandir(category.path):
+                if entry.is_dir():
+                    roots.append(entry.path)
+                else:
+                    found.add(entry.path)
+
+    def walk(root: str) -> List[str]:
+        return [
+            os.path.join(dirpath, name) for dirpath, _, names in os.walk(root) for name in names
+        ]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for paths in executor.map(walk, roots):
+            found.update(paths)
+    return {p for p in found if p.endswith(".pdf") and not os.path.basename(p).startswith(".")}
+
+
+def plan_reconciliation(on_disk: Set[str], catalog: Iterable[Tuple[int, str]]) -> ReconcilePlan:
+    """カタログとディスク上のファイルを突き合わせる
+
+    カタログにあってディスクに無い書籍は、同じファイル名(無ければ同じタイトルのキー)のファイルがカタログの外に
+    1つだけあれば移動したものとみなす. 見つからなければ削除する
+
+    Args:
+        on_disk (Set[str]): ディスク上のpdfの絶対パス
+        catalog (Iterable[Tuple[int, str]]): カタログの(id, 移動先)
+
+    Returns:
+        ReconcilePlan: 差分
+    """
+    plan = ReconcilePlan()
+    known = set()
+    missing = []
+    for book_id, destination in catalog:
+        destination = os.path.normpath(os.path.abspath(destination))
+        known.add(destination)
+        if destination in on_disk:
+            plan.n_unchanged += 1
+        else:
+            missing.append((book_id, destination))
+    orphans = on_disk - known
+
+    for key_func in (os.path.basename, _title_key):
+        candidates: Dict[str, List[str]] = defaultdict(list)
+        for path in orphans:
+            candidates[key_func(path)].append(path)
+        wanted: Dict[str, int] = defaultdict(int)
+        for _, destination in missing:
+            wanted[key_func(destination)] += 1
+
+        still_missing = []
+        for book_id, destination in missing:
+            key = key_func(destination)
+            if wanted[key] == 1 and len(candidates[key]) == 1:
+                new_destination = candidates[key][0]
+                plan.moved.append((book_id, new_destination))
+                orphans.discard(new_destination)
+            else:
+                still_missing.append((book_id, destination))
+        missing = still_missing
+
+    plan.added = sorted(orphans)
+    plan.deleted = [book_id for book_id, _ in missing]
+    return plan
+
+
+def derive_book(output_dir: Path, path: str) -> dict:
+    """construct_dstのディレクトリ構造からカタログの行を作る
+
+    output_dir/カテゴリ/(シリーズ or 小分類/シリーズ)/タイトル.pdf
+
+    Args:
+        output_dir (Path): 出力先のディレクトリ
+        path (str): pdfの絶対パス
+
+    Returns:
+        dict: title, categories, destinationのdict. カテゴリが分からなければcategoriesはNone
+    """
+    relative = Path(path).relative_to(Path(output_dir).absolute())
+    return {
+        "title": relative.stem,
+        "categories": relative.parts[0] if len(relative.parts) > 1 else None,
+        "destination": path
+    }
+
+
+def check_plan(plan: ReconcilePlan, n_on_disk: int, n_catalog: int,
+               max_delete_fraction: float = MAX_DELETE_FRACTION) -> None:
+    """output_dirがマウントされていないときなどにカタログを消してしまわないように差分を確かめる
+
+    Args:
+        plan (ReconcilePlan): 差分
+        n_on_disk (int): ディスク上のpdfの数
+        n_catalog (int): カタログの書籍の数
+        max_delete_fraction (float, optional): 消してよいカタログの割合の上限
+
+    Raises:
+        ReconcileSafetyError: ディスクにpdfが1つも無いか、消す書籍が多すぎるときのエラー
+    """
+    if n_catalog == 0:
+        return
+    if n_on_disk == 0:
+        raise ReconcileSafetyError(
+            f"No pdf found in output_dir but the catalog has {n_catalog} books. "
+            "Check that output_dir is mounted, or use --force.")
+    if len(plan.deleted) > n_catalog * max_delete_fraction:
+        raise ReconcileSafetyError(
+            f"Refusing to delete {len(plan.deleted)} of {n_catalog} books. "
+            "Use --force if the files were really removed.")
+
+
+def reconcile(output_dir: Path, db: DatabaseCliant, n_workers: int = 8,
+              dry_run: bool = False, force: bool = False) -> ReconcilePlan:
+    """output_dirを正としてカタログを直す
+
+    Args:
+        output_dir (Path): 出力先のディレクトリ
+        db (DatabaseCliant): データベースのクライアント
+        n_workers (int, optional): 並列に走査するスレッド数
+        dry_run (bool, optional): Trueならカタログを書き換えない
+        force (bool, optional): Trueなら消す書籍が多くても書き換える
+
+    Raises:
+        ReconcileSafetyError: forceでなく、check_planで止めたときのエラー
+
+    Returns:
+        ReconcilePlan: 適用した差分
+    """
+    on_disk = scan_output_dir(output_dir, n_workers)
+    catalog = db.list_destinations()
+    plan = plan_reconciliation(on_disk, catalog)
+    if not dry_run and not force:
+        check_plan(plan, len(on_disk), len(catalog))
+    if not dry_run:
+        db.apply_reconciliation(plan.moved, [derive_book(output_dir, p) for p in plan.added],
+                                plan.deleted)
+    return plan
+
+
+def _title_key(path: str) -> str:
+    return bookinfo_util.title_key(Path(path).stem)
+
+
+class ReconcileSafetyError(Exception):
+    pass
+
+
+def parser() -> Namespace:
+    usage = f"python3 {__file__} [--dry-run] [--force] [--workers N]"
+    argparser = ArgumentParser(usage=usage)
+    argparser.add_argument("--dry-run",
+                           action="store_true",
+                           help="Show differences without changing the database.")
+    argparser.add_argument("--force",
+                           action="store_true",
+                           help="Apply even when output_dir is empty or most of the catalog "
+                           "would be deleted.")
+    argparser.add_argument("--workers",
+                           type=int,
+                           default=8,
+                           help="Number of threads walking output_dir.")
+    args = argparser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parser()
+    with open(Path(__file__).resolve().parents[1] / "config.yml") as f:
+        config = yaml.safe_load(f)
+    db_cliant = DatabaseCliant(Path(config["database_path"]))
+    try:
+        result = reconcile(Path(config["output_dir"]), db_cliant, args.workers, args.dry_run,
+                           args.force)
+    finally:
+        db_cliant.close()
+    print(f"unchanged: {result.n_unchanged}")
+    print(f"moved: {len(result.moved)}")
+    for book_id, destination in result.moved:
+        print(f"\t{book_id} -> {destination}")
+    print(f"added: {len(result.added)}")
+    for destination in result.added:
+        print(f"\t{destination}")
+    print(f"deleted: {len(result.deleted)}")
@@ -1,14 +1,31 @@
 import shutil
 from argparse import ArgumentParser, Namespace
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
+from typing import Callable, Optional, Tuple
 
+import requests
 import yaml
+from selenium.common.exceptions import WebDriverException
 
+from autotune import DEFAULT_AUTOTUNE_CONFIG, AutoTuner
+from config import load_section
 from databese import DatabaseCliant
 from ehon import EhonDoesNotHaveDataError, EhonSearchCliant
-from honto import HontoDoesNotHaveDataError, HontoSearchCliant
+from filing import DEFAULT_FILING_CONFIG, BookFiler
+from fingerprint import (DEFAULT_FINGERPRINT_CONFIG, DuplicateBookError, FingerprintIndex,
+                         FingerprintMatcher)
+from honto import HontoDoesNotHaveDataError, HontoSearchCliant, HontoThrottledError
+from lease import DEFAULT_WORKER_CONFIG, LeaseManager, exclusive_lock, original_path
+from metrics import RunMetrics, profile_call
 from mylogger import MyLogger
-from scan_isbn import scan_isbn
+from optimize import DEFAULT_OPTIMIZE_CONFIG, PdfOptimizer, build_commands
+from pipeline import DEFAULT_PIPELINE_CONFIG, BookJob, BookPipeline
+from scan_isbn import cover_fingerprint, scan_isbn
+
+# 取得先の混雑や通信の失敗. 書籍は動かさずに次の実行でやり直す
+TRANSIENT_LOOKUP_ERRORS = (HontoThrottledError, requests.RequestException, WebDriverException)
 
 
 def show_title() -> None:
@@ -24,14 +41,29 @@ def show_title() -> None:
     print("===============================================")
 
 
-def send_err_dir(target: Path, dst: Path) -> None:
-    """エラーが起きたpdfファイルを移動する
+def send_err_dir(target: Path,
+                 dst: Path,
+                 filer: Optional[BookFiler] = None,
+                 dir_name: str = "tmp",
+                 on_publish: Optional[Callable[[Path], None]] = None) -> None:
+    """エラーが起きたpdfファイルを移動する. 既にdst/dir_nameの中にあるものはそのままにする
 
     Args:
         target (Path): 対象のpdf
         dst (Path): 行き先
+        filer (Optional[BookFiler], optional): 移動に使うBookFiler. 無ければその場で移動する
+        dir_name (str, optional): dstの下の移動先のディレクトリ名
+        on_publish (Optional[Callable[[Path], None]], optional): filerでの移動が確定したときに呼ぶ関数
     """
-    dst = dst / "tmp"
+    dst = dst / dir_name
+    if dst.resolve() in Path(target).resolve().parents:
+        # 補完用のcsvで再び失敗したtmpの本. 動かすと自分自身と衝突して"_2"が付いてしまう
+        if on_publish is not None:
+            on_publish(Path(target))
+        return
+    if filer is not None:
+        filer.move(target, dst / original_path(target).name, on_publish)
+        return
     dst.mkdir(parents=True, exist_ok=True)
     shutil.move(str(target), dst)
 
@@ -46,7 +78,13 @@ def generate_config_file(config_path: Path) -> None:
     config = {
         "input_dir": "",
         "output_dir": "",
-        "database_path": str(Path(__file__).resolve().parents[1] / "books.sqlite3")
+        "database_path": str(Path(__file__).resolve().parents[1] / "books.sqlite3"),
+        "pipeline": DEFAULT_PIPELINE_CONFIG,
+        "filing": DEFAULT_FILING_CONFIG,
+        "worker": DEFAULT_WORKER_CONFIG,
+        "fingerprint": DEFAULT_FINGERPRINT_CONFIG,
+        "optimize": DEFAULT_OPTIMIZE_CONFIG,
+        "autotune": DEFAULT_AUTOTUNE_CONFIG
     }
 
     print("Cannot find config file.")
@@ -74,7 +112,7 @@ def generate_config_file(config_path: Path) -> None:
                 else:
                     print("Type [y/n]: ")
         else:
-            path = ""
+            continue
         config[key] = str(path)
 
     with open(config_path, "w") as f:
@@ -107,6 +145,25 @@ def fetch_book_info_from_pdf(pdf_path: Path, honto: HontoSearchCliant,
     return fetch_book_info_from_isbn(isbn_code, honto, ehon)
 
 
+def scan_isbn_or_raise(pdf_path: Path) -> Tuple[str, dict]:
+    """pdfからISBNを読み取る. パイプラインのOCRステージ(別プロセス)で実行する
+
+    Args:
+        pdf_path (Path): pdfファイルのパス
+
+    Raises:
+        NotFoundIsbnError: pdfからISBNコードを検出できなかったエラー
+
+    Returns:
+        Tuple[str, dict]: isbnとOCRの内訳ごとの秒数
+    """
+    timings = {}
+    isbn_code = scan_isbn(pdf_path, timings=timings)
+    if isbn_code is None:
+        raise NotFoundIsbnError(f"Not found isbn in {pdf_path=}")
+    return isbn_code, timings
+
+
 def fetch_book_info_from_isbn(isbn: str, honto: HontoSearchCliant,
                               ehon: EhonSearchCliant) -> dict:
     """isbnを元に書籍情報を取得する
@@ -157,11 +214,166 @@ def construct_dst(parent_path: Path, book_info: dict) -> Path:
     return dst
 
 
+class BookInfoFetcher:
+    """取得スレッドごとに持つHonto/E-honのクライアントの組
+    """
+    def __init__(self, metrics: Optional[RunMetrics] = None) -> None:
+        self.honto = HontoSearchCliant(metrics)
+        self.ehon = EhonSearchCliant(metrics)
+
+    def __call__(self, isbn: str) -> dict:
+        return fetch_book_info_from_isbn(isbn, self.honto, self.ehon)
+
+    def close(self) -> None:
+        self.ehon.close()
+
+
+def file_book(job: BookJob,
+              config: dict,
+              logger: MyLogger,
+              db: DatabaseCliant,
+              filer: BookFiler,
+              metrics: Optional[RunMetrics] = None,
+              index: Optional[FingerprintIndex] = None,
+              optimizer: Optional[PdfOptimizer] = None,
+              on_publish: Optional[Callable[[Path], None]] = None) -> Optional[Path]:
+    """パイプラインの最後で書籍を移動し、データベースに書き込む
+
+    ログとデータベースへの書き込みは移動が確定してから行う. 別のファイルシステムへのコピーでは
+    BookFilerのflushまで遅れ、確定できなかった本は書き込まない
+    dry runのときは移動先を表示するだけでログやデータベースには書かない
+    表紙の指紋が既存の本と一致して重複とされたものはduplicatesに移動する
+    取得が一時的に失敗したもの(TRANSIENT_LOOKUP_ERRORS)は元の場所に残し、次の実行でやり直す
+
+    Args:
+        job (BookJob): 処理の終わったジョブ
+        config (dict): configのdict
+        logger (MyLogger): logger
+        db (DatabaseCliant): データベースのクライアント
+        filer (BookFiler): 移動に使うBookFiler
+        metrics (Optional[RunMetrics], optional): 処理した冊数の記録先
+        index (Optional[FingerprintIndex], optional): 格納した書籍の指紋を加える索引
+        optimizer (Optional[PdfOptimizer], optional): 移動を終えたpdfを最適化するPdfOptimizer
+        on_publish (Optional[Callable[[Path], None]], optional): 移動(とデータベースへの書き込み)が
+            確定したときに移動先を渡して呼ぶ関数. tmpやduplicatesへの移動でも呼ぶ
+
+    Returns:
+        Optional[Path]: 移動先の予定. エラーでtmpかduplicatesに移動したときと、動かさなかったときはNone
+    """
+    print(str(job.path))
+    if isinstance(job.error, DuplicateBookError):
+        send_err_dir(job.path, Path(config["output_dir"]), filer, "duplicates", on_publish)
+        if not filer.dry_run:
+            logger.write("DUPLICATE", str(job.error))
+        return None
+    if isinstance(job.error, TRANSIENT_LOOKUP_ERRORS):
+        if not filer.dry_run:
+            logger.write("ERROR", f"{job.path}: {type(job.error).__name__}: {job.error}")
+        return None
+    if job.error is not None:
+        if not isinstance(job.error, (NotFoundIsbnError, HontoDoesNotHaveDataError)):
+            raise job.error
+        send_err_dir(job.path, Path(config["output_dir"]), filer, on_publish=on_publish)
+        if not filer.dry_run:
+            logger.write("ERROR", str(job.error))
+        return None
+
+    book_info = job.info
+
+    def publish(dst: Path) -> None:
+        logger.write("SUCCESS", dst)
+
+        # データベースに情報を追加
+        fetch_result = {
+            "title": book_info["title"],
+            "isbn": book_info["isbn"],
+            "authors": "\t".join(book_info["authors"] or [""]),
+            "publishers": book_info["publisher"],
+            "categories": book_info["category"],
+            "destination": str(dst)
+        }
+
+        book_id = db.store(fetch_result)
+        cover = job.extras.get("cover_fingerprint")
+        if cover is not None:
+            back = job.extras.get("back_fingerprint")
+            db.store_fingerprint(book_id, cover, back)
+            if index is not None:
+                index.add(str(dst), cover, book_info["isbn"], back)
+        if optimizer is not None:
+            optimizer.submit(dst)
+        if metrics is not None:
+            metrics.count("books")
+        if on_publish is not None:
+            on_publish(dst)
+
+    dst = filer.move(job.path, construct_dst(config["output_dir"], book_info), publish)
+    if filer.dry_run:
+        print(f"\t-> {dst}")
+    return dst
+
+
 class NotFoundIsbnError(Exception):
     pass
 
 
-def main():
+def worker_catalog_path(database_path: Path, owner: str) -> Path:
+    """ワーカーごとのカタログのpath. books.sqlite3 -> books.[owner].sqlite3"""
+    return database_path.with_name(f"{database_path.stem}.{owner}{database_path.suffix}")
+
+
+def merge_worker_catalog(database_path: Path, worker_path: Path, wait_seconds: float) -> None:
+    """ワーカーのカタログをメインのカタログに取り込み、消す
+
+    Args:
+        database_path (Path): メインのカタログのpath
+        worker_path (Path): ワーカーのカタログのpath
+        wait_seconds (float): 他のワーカーの取り込みを待つ最大の秒数
+    """
+    with exclusive_lock(database_path, wait_seconds=wait_seconds):
+        db = DatabaseCliant(database_path)
+        try:
+            n = db.merge_from(worker_path)
+        finally:
+            db.close()
+    worker_path.unlink()
+    print(f"merged {n} books from {worker_path}")
+
+
+def store_optimize_results(db: DatabaseCliant, optimizer: PdfOptimizer, wait: bool = False) -> None:
+    """終わった最適化の前後のサイズをデータベースに書き込む
+
+    Args:
+        db (DatabaseCliant): データベースのクライアント
+        optimizer (PdfOptimizer): 最適化を予約したPdfOptimizer
+        wait (bool, optional): Trueなら予約したものがすべて終わるまで待つ
+    """
+    results = optimizer.close() if wait else optimizer.drain()
+    db.update_sizes([(str(r.path), r.original_size, r.optimized_size) for r in results])
+
+
+def load_fingerprint_index(db: DatabaseCliant,
+                           index: Optional[FingerprintIndex] = None) -> FingerprintIndex:
+    """カタログにある書籍の指紋を索引に読み込む
+
+    Args:
+        db (DatabaseCliant): データベースのクライアント
+        index (Optional[FingerprintIndex], optional): 読み込み先. 無ければ新しく作る
+
+    Returns:
+        FingerprintIndex: 索引
+    """
+    if index is None:
+        index = FingerprintIndex()
+    for destination, cover, back, isbn in db.load_fingerprints():
+        index.add(destination, cover, isbn, back)
+    return index
+
+
+def main(dry_run: bool = False,
+         profile_target: Optional[Path] = None,
+         worker: bool = False,
+         worker_id: Optional[str] = None):
     logger = MyLogger()
     profect_dir = Path(__file__).resolve().parents[1]
     config_path = profect_dir / "config.yml"
@@ -172,41 +384,117 @@ def main():
     with open(config_path, "r") as f:
         config = yaml.safe_load(f)
 
-    Path(config["output_dir"]).mkdir(exist_ok=True, parents=True)
-    db_cliant = DatabaseCliant(Path(config["database_path"]))
-    honto_cliant = HontoSearchCliant()
-    ehon_cliant = EhonSearchCliant()
-
-    # input_dir内のPDFに対して処理をする
-    for pdf_file in Path(config["input_dir"]).glob("**/*.pdf"):
+    if profile_target is not None:
+        # 1冊だけOCRと書籍情報の取得をプロファイルする. ファイルは動かさない
+        fetcher = BookInfoFetcher()
         try:
-            book_info = fetch_book_info_from_pdf(pdf_file, honto_cliant, ehon_cliant)
-        except NotFoundIsbnError as e:
-            send_err_dir(pdf_file, Path(config["output_dir"]))
-            logger.write("ERROR", str(e))
-            continue
-        except HontoDoesNotHaveDataError as e:
-            send_err_dir(pdf_file, Path(config["output_dir"]))
-            logger.write("ERROR", str(e))
-            continue
-
-        dst = construct_dst(config["output_dir"], book_info)
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        shutil.move(str(pdf_file), dst)
-        logger.write("SUCCESS", dst)
-
-        # データベースに情報を追加
-        fetch_result = {
-            "title": book_info["title"],
-            "isbn": book_info["isbn"],
-            "authors": "\t".join(book_info["authors"] or [""]),
-            "publishers": book_info["publisher"],
-            "categories": book_info["category"],
-            "destination": str(dst)
-        }
+            print(profile_call(fetch_book_info_from_pdf, profile_target, fetcher.honto,
+                               fetcher.ehon, output=profect_dir / "book_profile.pstats"))
+        finally:
+            fetcher.close()
+        return
 
-        db_cliant.store(fetch_result)
-    db_cliant.close()
+    Path(config["output_dir"]).mkdir(exist_ok=True, parents=True)
+    database_path = Path(config["database_path"])
+    owner_lock = nullcontext()
+    if worker:
+        # 複数のワーカーで共有のinput_dirを分け合う. 書籍はワーカーごとのカタログに書き、最後にまとめる
+        worker_config = load_section(config, "worker", DEFAULT_WORKER_CONFIG)
+        lease = LeaseManager(worker_id, worker_config["lease_seconds"])
+        database_path = worker_catalog_path(database_path, lease.owner)
+        # 同じワーカー名のプロセスが動いていたら止める. カタログの統合を終えるまで持ち続ける
+        owner_lock = lease.exclusive(database_path)
+
+    with owner_lock:
+        metrics = RunMetrics(profect_dir / "book_metrics.jsonl")
+        db_cliant = DatabaseCliant(database_path, metrics)
+        filer = BookFiler(dry_run=dry_run, metrics=metrics,
+                          **load_section(config, "filing", DEFAULT_FILING_CONFIG))
+        fingerprint_config = load_section(config, "fingerprint", DEFAULT_FINGERPRINT_CONFIG)
+        index = None
+        shortcut = {}
+        if fingerprint_config["enabled"]:
+            # 表紙の指紋が既存の本と一致したらOCRを飛ばす
+            index = load_fingerprint_index(db_cliant)
+            if worker:
+                with exclusive_lock(Path(config["database_path"]),
+                                    wait_seconds=worker_config["merge_wait_seconds"]):
+                    main_db = DatabaseCliant(Path(config["database_path"]))
+                    try:
+                        load_fingerprint_index(main_db, index)
+                    finally:
+                        main_db.close()
+            shortcut = {
+                "fingerprint": partial(cover_fingerprint,
+                                       width=fingerprint_config["thumbnail_width"]),
+                "match": FingerprintMatcher(index, fingerprint_config["threshold"],
+                                            fingerprint_config["on_match"])
+            }
+        pipeline = BookPipeline(scan_isbn_or_raise, partial(BookInfoFetcher, metrics),
+                                metrics=metrics, **shortcut,
+                                **load_section(config, "pipeline", DEFAULT_PIPELINE_CONFIG))
+
+        autotune_config = load_section(config, "autotune", DEFAULT_AUTOTUNE_CONFIG)
+        tuning = nullcontext()
+        if autotune_config["enabled"]:
+            # pipelineの並列数を上限に、CPUとメモリと処理の詰まり具合を見て並列数を変える
+            def log_autotune(message: str) -> None:
+                print(f"autotune: {message}")
+                logger.write("AUTOTUNE", message)
+
+            rss_limit_mb = autotune_config["rss_limit_mb"]
+            tuning = AutoTuner(pipeline,
+                               metrics,
+                               rss_limit=rss_limit_mb and rss_limit_mb << 20,
+                               ocr_memory=autotune_config["ocr_memory_mb"] << 20,
+                               lookup_memory=autotune_config["lookup_memory_mb"] << 20,
+                               interval=autotune_config["interval_seconds"],
+                               log=log_autotune).running()
+
+        optimize_config = load_section(config, "optimize", DEFAULT_OPTIMIZE_CONFIG)
+        optimizer = None
+        if optimize_config["enabled"] and not dry_run:
+            # 移動したpdfを裏で再圧縮・線形化する
+            commands = build_commands(optimize_config["recompress"], optimize_config["image_dpi"],
+                                      optimize_config["mono_dpi"], optimize_config["linearize"])
+            if commands:
+                optimizer = PdfOptimizer(commands, optimize_config["workers"], metrics)
+            else:
+                print("optimize is enabled but neither gs nor qpdf is installed.")
+
+        def file(job: BookJob) -> None:
+            # リースは移動が確定してから手放す. 別のファイルシステムへのコピーではflushまで確保し続ける
+            release = (lambda dst: lease.release(job.path)) if worker else None
+            file_book(job, config, logger, db_cliant, filer, metrics, index, optimizer, release)
+            if optimizer is not None:
+                store_optimize_results(db_cliant, optimizer)
+
+        # input_dir内のPDFに対して処理をする
+        try:
+            with tuning:
+                if worker:
+                    with lease.heartbeat():
+                        pipeline.run(
+                            (BookJob(pdf) for pdf in lease.claims(Path(config["input_dir"]))),
+                            file)
+                        filer.close()    # 移動を確定してからリースを手放す
+                else:
+                    jobs = (BookJob(pdf_file)
+                            for pdf_file in sorted(Path(config["input_dir"]).glob("**/*.pdf")))
+                    pipeline.run(jobs, file)
+        finally:
+            try:
+                filer.close()
+            finally:
+                if optimizer is not None:
+                    store_optimize_results(db_cliant, optimizer, wait=True)
+                db_cliant.close()
+            metrics.write_summary()
+            metrics.close()
+
+        if worker:
+            merge_worker_catalog(Path(config["database_path"]), database_path,
+                                 worker_config["merge_wait_seconds"])
 
 
 def parser() -> Namespace:
@@ -217,11 +505,29 @@ def parser() -> Namespace:
     """
     usage = f"Usage: python {__file__}"
     argparser = ArgumentParser(usage=usage)
+    argparser.add_argument("--dry-run",
+                           action="store_true",
+                           help="Show destinations without moving files or writing the database.")
+    argparser.add_argument("--profile",
+                           metavar="PDF",
+                           help="Profile OCR and lookup of a single pdf with cProfile and tracemalloc.")
+    argparser.add_argument("--worker",
+                           action="store_true",
+                           help="Share input_dir with other workers through leases.")
+    argparser.add_argument("--worker-id",
+                           help="Name of this worker (default: hostname). Give each worker on "
+                           "the same host its own name and reuse it after a crash to pick up its "
+                           "leases and catalog.")
     args = argparser.parse_args()
+    if args.worker and args.dry_run:
+        argparser.error("--dry-run cannot be used with --worker")
     return args
 
 
 if __name__ == "__main__":
     show_title()
     args = parser()
-    main()
+    main(dry_run=args.dry_run,
+         profile_target=args.profile and Path(args.profile),
+         worker=args.worker,
+         worker_id=args.worker_id)
@@ -1,5 +1,5 @@
-import re
 import tempfile
+import time
 from pathlib import Path
 from typing import Optional, Union
 
@@ -7,67 +7,85 @@ import pdf2image
 import pyocr
 import PyPDF2
 
+from fingerprint import dhash
+from isbn import IsbnVoter
 
-def scan_isbn(input_file: Union[str, Path], n_use_pages: int = 13) -> Optional[str]:
-    """入力されたパスのPDFを読み取りISBN番号を返す 
+
+def scan_isbn(input_file: Union[str, Path],
+              n_use_pages: int = 13,
+              timings: Optional[dict] = None) -> Optional[str]:
+    """入力されたパスのPDFを読み取りISBN番号を返す
+
+    後ろのページから1ページずつOCRし、チェックディジットの合うISBNの候補を集める
+    候補が十分に揃ったらそこで読むのをやめる
 
     Args:
         input_file (str | Path): スキャン対象のpdfファイルへのPath
         n_use_pages (int, optional): 最後から何ページをスキャン対象とするか
         たまに背表紙+同版元の宣伝が3ページぐらい入っているのでカバー+背表紙+宣伝3ページぐらいを考慮し
         デフォルト値を13としている
+        timings (Optional[dict], optional): 渡されたら"render"と"tesseract"にかかった秒数を書き込む
 
     Returns:
-        Optional[str]: スキャンの結果得られたISBNコード(978から始まる13桁、または旧コードの10桁)
-        見つからなかったらNoneを返す（何も返さない）
+        Optional[str]: スキャンの結果得られたISBNコード(旧コードの10桁も978から始まる13桁にそろえる)
+        チェックディジットの合う候補が見つからなかったらNoneを返す
     """
 
     with open(input_file, "rb") as f:
         n_pages = PyPDF2.PdfFileReader(f).getNumPages()
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        end_of_pages = pdf2image.convert_from_path(input_file,
-                                                   first_page=n_pages - n_use_pages,
-                                                   output_folder=tmp_dir,
-                                                   fmt="jpeg")
+    if timings is None:
+        timings = {}
+    timings.setdefault("render", 0.0)
+    timings.setdefault("tesseract", 0.0)
 
-        isbn_code = None
+    voter = IsbnVoter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 後ろのほうがコードがある確率が高いので逆順
+        for page_number in range(n_pages, max(1, n_pages - n_use_pages) - 1, -1):
+            start = time.perf_counter()
+            page = pdf2image.convert_from_path(input_file,
+                                               first_page=page_number,
+                                               last_page=page_number,
+                                               output_folder=tmp_dir,
+                                               fmt="jpeg")[0]
+            timings["render"] += time.perf_counter() - start
 
-        for page in end_of_pages[::-1]:    # 後ろのほうがコードがある確率が高いので逆順
+            start = time.perf_counter()
             ocr_rst = pyocr.tesseract.image_to_string(page,
                                                       lang="eng")    # 日本語と誤認識されたくない
-            execlude_space = ocr_rst.replace(" ", "").replace("-", "")
-
-            # print(execlude_space)
-
-            isbn_code = (re.search(r'[Ii][Ss][Bb][Nn]([0-9]{12,13})', execlude_space)
-                         or re.search(r'[Ii][Ss][Bb][Nn]([0-9X]{9,10})', execlude_space)
-                         or re.search(r"(978[0-9]{9,10})", execlude_space))
-            if isbn_code:
-                return modify_missing(isbn_code.group(1))
-
-
-def modify_missing(isbn: str):
-    n_code = len(isbn)
-    total = 0
-    if n_code == 12:    # isbn13の末尾欠損
-        for i, number in zip(range(n_code), map(int, isbn)):
-            total += number * (1 + 2 * (i % 2))
-        c = (10 - (total % 10)) % 10
-        isbn += str(c)
-    elif n_code == 9:    # isbn10の末尾欠損
-        for i, number in zip(range(n_code), map(int, isbn)):
-            total += (10 - i) * number
-        c = (11 - total % 11) % 11
-        if c == 10:
-            c = "X"
-        isbn += str(c)
-    return isbn
+            timings["tesseract"] += time.perf_counter() - start
+
+            voter.add_text(ocr_rst)
+            if voter.is_confident():
+                break
+
+    return voter.best()
+
+
+def cover_fingerprint(input_file: Union[str, Path], width: int = 64) -> dict:
+    """表紙と裏表紙だけを小さく描画して指紋を取る. OCRより先に既存の本と照合するために使う
+
+    裏表紙は同じシリーズの表紙のよく似た別の巻と見分けるために使う
+
+    Args:
+        input_file (str | Path): pdfファイルへのPath
+        width (int, optional): 描画する幅(px)
+
+    Returns:
+        dict: {"cover_fingerprint": 表紙の指紋, "back_fingerprint": 裏表紙の指紋}
+    """
+    with open(input_file, "rb") as f:
+        n_pages = PyPDF2.PdfFileReader(f).getNumPages()
+    cover = pdf2image.convert_from_path(input_file, first_page=1, last_page=1,
+                                        size=(width, None))[0]
+    back = pdf2image.convert_from_path(input_file, first_page=n_pages, last_page=n_pages,
+                                       size=(width, None))[0]
+    return {"cover_fingerprint": dhash(cover), "back_fingerprint": dhash(back)}
 
 
 if __name__ == "__main__":
     pass
-    # print(modify_missing("409126168"))
     # project_dir = Path(__file__).resolve().parents[1]
     # print(project_dir)
     # for book in glob.glob(os.path.join(project_dir, "test_books/*.pdf")):
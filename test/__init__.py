@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# src/の中のモジュールは互いを"import filing"のように読み込むので、スクリプトとして実行したときと同じく
+# src/を探索パスに加える
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
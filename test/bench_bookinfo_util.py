@@ -0,0 +1,44 @@
+"""bookinfo_utilの整形のマイクロベンチマーク
+
+    $ python -m test.bench_bookinfo_util
+"""
+import random
+import timeit
+
+from src import bookinfo_util
+from test.test_bookinfo_util import (legacy_format_authors, legacy_format_publisher,
+                                     legacy_format_title, random_text)
+
+
+def main(n_inputs: int = 500, repeat: int = 20) -> None:
+    rng = random.Random(0)
+    titles = [random_text(rng) for _ in range(n_inputs)]
+    authors = [[random_text(rng), random_text(rng)] for _ in range(n_inputs)]
+
+    cases = [
+        ("format_title", legacy_format_title, bookinfo_util.format_title,
+         bookinfo_util.format_title, titles),
+        ("format_authors", legacy_format_authors, bookinfo_util.format_authors,
+         bookinfo_util._format_author, authors),
+        ("format_publisher", legacy_format_publisher, bookinfo_util.format_publisher,
+         bookinfo_util.format_publisher, titles),
+    ]
+    for name, legacy, current, memo, inputs in cases:
+        for x in inputs:
+            assert legacy(x) == current(x), x
+
+        def cold():
+            # メモを使わないときの速さ
+            memo.cache_clear()
+            return [current(x) for x in inputs]
+
+        t_legacy = min(timeit.repeat(lambda: [legacy(x) for x in inputs], number=repeat))
+        t_cold = min(timeit.repeat(cold, number=repeat))
+        t_warm = min(timeit.repeat(lambda: [current(x) for x in inputs], number=repeat))
+        print(f"{name}: legacy {t_legacy * 1e3:.2f}ms, cold {t_cold * 1e3:.2f}ms "
+              f"(x{t_legacy / t_cold:.1f}), memoized {t_warm * 1e3:.2f}ms "
+              f"(x{t_legacy / t_warm:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""カタログの照合のベンチマーク. 合成したoutput_dirで走査と突き合わせの時間を測る
+
+    $ python -m test.bench_reconcile
+"""
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from src.reconcile import plan_reconciliation, scan_output_dir
+
+
+def build_tree(output_dir: Path, n_books: int, rng: random.Random) -> list:
+    """カテゴリ/小分類/シリーズ/タイトル.pdfの木を作り、カタログの(id, 移動先)を返す"""
+    catalog = []
+    for book_id in range(n_books):
+        path = (output_dir / f"category{rng.randrange(10)}" / f"sub{rng.randrange(20)}" /
+                f"series{rng.randrange(200)}" / f"title{book_id}.pdf")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+        catalog.append((book_id, str(path)))
+    return catalog
+
+
+def main(n_books: int = 20000, n_changes: int = 500) -> None:
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp) / "output"
+        catalog = build_tree(output_dir, n_books, rng)
+        # 一部を移動、削除し、カタログに無い本を加える
+        changed = rng.sample(catalog, 2 * n_changes)
+        for _, destination in changed[:n_changes]:
+            moved = output_dir / "moved" / Path(destination).name
+            moved.parent.mkdir(parents=True, exist_ok=True)
+            Path(destination).rename(moved)
+        for _, destination in changed[n_changes:]:
+            Path(destination).unlink()
+        for i in range(n_changes):
+            (output_dir / "moved" / f"new{i}.pdf").touch()
+
+        for n_workers in (1, 8):
+            start = time.perf_counter()
+            on_disk = scan_output_dir(output_dir, n_workers)
+            print(f"scan_output_dir(workers={n_workers}): {time.perf_counter() - start:.3f}s "
+                  f"({len(on_disk)} files)")
+
+        start = time.perf_counter()
+        plan = plan_reconciliation(on_disk, catalog)
+        print(f"plan_reconciliation: {time.perf_counter() - start:.3f}s "
+              f"(unchanged {plan.n_unchanged}, moved {len(plan.moved)}, "
+              f"added {len(plan.added)}, deleted {len(plan.deleted)})")
+        assert len(plan.moved) == n_changes
+        assert len(plan.added) == n_changes
+        assert len(plan.deleted) == n_changes
+
+
+if __name__ == "__main__":
+    main()
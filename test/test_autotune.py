@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from src.autotune import AutoTuner, available_memory, process_tree_rss
+from src.metrics import RunMetrics
+from src.pipeline import ConcurrencyLimit
+
+MB = 1 << 20
+
+
+class FakePipeline:
+    def __init__(self, ocr_workers: int = 4, lookup_workers: int = 4) -> None:
+        self.ocr_workers = ocr_workers
+        self.lookup_workers = lookup_workers
+        self.ocr_limit = ConcurrencyLimit(ocr_workers)
+        self.lookup_limit = ConcurrencyLimit(lookup_workers)
+        self.queue_size = 8
+        self.depths = {"ocr": 0, "lookup": 0, "file": 0}
+
+    def queue_depths(self) -> dict:
+        return dict(self.depths)
+
+
+class TestAutoTuner(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = FakePipeline()
+        self.metrics = RunMetrics()
+        self.rss = 0
+        self.logs = []
+        self.tuner = AutoTuner(self.pipeline,
+                               self.metrics,
+                               rss_limit=2000 * MB,
+                               ocr_memory=300 * MB,
+                               lookup_memory=400 * MB,
+                               log=self.logs.append,
+                               rss=lambda: self.rss,
+                               cpus=3,
+                               available=lambda: 4000 * MB)
+
+    def test_initial_limits(self):
+        # OCRはCPUの数とメモリの半分、取得は残りのメモリで決まる
+        self.assertEqual({"ocr": 3, "lookup": 2}, self.tuner.initial_limits())
+        self.assertEqual(2, len(self.logs))
+
+    def test_shrink_over_rss_limit(self):
+        self.rss = 2500 * MB
+        self.assertIsNotNone(self.tuner.step())
+        self.assertEqual(3, self.pipeline.lookup_limit.limit)    # 4*400MB > 4*300MB
+        self.assertEqual(4, self.pipeline.ocr_limit.limit)
+
+    def test_shrink_lookup_on_errors(self):
+        self.metrics.count("error.lookup.HontoDoesNotHaveDataError")
+        self.assertIsNone(self.tuner.step())
+        self.metrics.count("error.lookup.ConnectionError")
+        self.tuner.step()
+        self.assertEqual(3, self.pipeline.lookup_limit.limit)
+
+    def test_shrink_lookup_when_throttled(self):
+        # 制限はhonto.throttledで数えるので、同じ制限を取得のエラーとしては数えない
+        self.metrics.count("honto.throttled")
+        self.metrics.count("error.lookup.HontoThrottledError")
+        self.assertIn("+1", self.tuner.step())
+        self.assertEqual(3, self.pipeline.lookup_limit.limit)
+        self.assertIsNone(self.tuner.step())
+
+    def test_grow_and_revert(self):
+        self.pipeline.ocr_limit.set(1)
+        self.pipeline.depths["ocr"] = 8
+        self.metrics.record("ocr", 10.0)
+        self.tuner.step()
+        self.assertEqual(2, self.pipeline.ocr_limit.limit)
+        # 2並列にしたら1冊あたり3倍かかるようになった
+        self.metrics.record("ocr", 30.0)
+        self.tuner.step()
+        self.assertEqual(1, self.pipeline.ocr_limit.limit)
+        self.assertEqual(1, self.tuner.ceilings["ocr"])
+        self.assertIsNone(self.tuner.step())
+        self.assertEqual(2, len(self.logs))
+
+    def test_grow_is_kept(self):
+        self.pipeline.ocr_limit.set(1)
+        self.pipeline.depths["ocr"] = 8
+        self.metrics.record("ocr", 10.0)
+        self.tuner.step()
+        self.assertEqual(2, self.pipeline.ocr_limit.limit)
+        # 遅くならなければそのまま次を増やす
+        self.metrics.record("ocr", 11.0)
+        self.tuner.step()
+        self.assertEqual(3, self.pipeline.ocr_limit.limit)
+        self.metrics.record("ocr", 11.0)
+        self.tuner.step()
+        self.tuner.step()
+        self.assertEqual(3, self.pipeline.ocr_limit.limit)    # CPUの数で止まる
+
+    def test_no_growth_without_memory(self):
+        self.pipeline.ocr_limit.set(1)
+        self.pipeline.depths["ocr"] = 8
+        self.rss = 1900 * MB
+        self.assertIsNone(self.tuner.step())
+        self.assertEqual(1, self.pipeline.ocr_limit.limit)
+
+
+class TestProcfs(unittest.TestCase):
+    @unittest.skipUnless(os.path.exists("/proc/self/statm"), "requires procfs")
+    def test_process_tree_rss(self):
+        self.assertGreater(process_tree_rss(), 0)
+
+    def test_available_memory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            meminfo = Path(tmp, "meminfo")
+            meminfo.write_text("MemTotal:       16000000 kB\nMemAvailable:    8000000 kB\n")
+            self.assertEqual(8000000 * 1024, available_memory(meminfo))
+            self.assertIsNone(available_memory(Path(tmp, "missing")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,5 @@
+import random
+import re
 import unittest
 
 from src import bookinfo_util
@@ -34,3 +36,51 @@ class TestBookinfoUtil(unittest.TestCase):
 
         # 中点の削除
         helper("hoge", "ho・ge")
+
+    def test_keys(self):
+        self.assertEqual(bookinfo_util.title_key("ＯＮＥ　ＰＩＥＣＥ【限定版】"),
+                         bookinfo_util.title_key("one piece"))
+        self.assertEqual(bookinfo_util.authors_key(["尾田 栄一郎(著)", "foo"]),
+                         bookinfo_util.authors_key(["foo", "尾田栄一郎"]))
+        self.assertEqual(bookinfo_util.publisher_key("ＫＡＤＯ・ＫＡＷＡ"),
+                         bookinfo_util.publisher_key("KADOKAWA"))
+        self.assertNotEqual(bookinfo_util.title_key("hoge1"), bookinfo_util.title_key("hoge2"))
+
+
+def legacy_format_title(title: str) -> str:
+    half_width = re.sub('[（）　:<>/="]', ' ', title)
+    deleted_option = re.sub(r"【.+】", "", half_width)
+    return re.sub(' +', '_', deleted_option.translate(bookinfo_util.z2h).strip())
+
+
+def legacy_format_authors(authors: list) -> list:
+    formatted = [re.sub(r"[\(（].+?[\)）]", "", author) for author in authors]
+    formatted = [re.sub(r"\s", "", author) for author in formatted]
+    return [f.translate(bookinfo_util.z2h) for f in formatted]
+
+
+def legacy_format_publisher(publisher: str) -> str:
+    return re.sub("・", "", publisher).translate(bookinfo_util.z2h)
+
+
+def random_text(rng: random.Random) -> str:
+    alphabet = 'ab AZ09ＡＺａｚ０９　（）:<>/="【】()・?!\t\n漫画'
+    return "".join(rng.choice(alphabet) for _ in range(rng.randrange(20)))
+
+
+class TestBookinfoUtilProperty(unittest.TestCase):
+    """整形の結果が以前の実装と同じであることをランダムな入力で確かめる"""
+    def test_same_as_legacy(self):
+        rng = random.Random(0)
+        for _ in range(3000):
+            text = random_text(rng)
+            self.assertEqual(legacy_format_title(text), bookinfo_util.format_title(text))
+            self.assertEqual(legacy_format_publisher(text), bookinfo_util.format_publisher(text))
+            authors = [text, random_text(rng)]
+            self.assertEqual(legacy_format_authors(authors), bookinfo_util.format_authors(authors))
+
+    def test_key_is_idempotent(self):
+        rng = random.Random(1)
+        for _ in range(1000):
+            key = bookinfo_util.normalize_key(random_text(rng))
+            self.assertEqual(key, bookinfo_util.normalize_key(key))
@@ -0,0 +1,180 @@
+import csv
+import tempfile
+import unittest
+from pathlib import Path
+
+from src.complession_from_csv import (CompletionReport, InvalidIsbnError, commit_batch,
+                                      file_csv_row, read_jobs)
+from src.databese import DatabaseCliant
+from src.filing import BookFiler
+from src.pipeline import BookJob
+
+
+class FakeLogger:
+    def __init__(self) -> None:
+        self.rows = []
+
+    def write(self, status: str, operand) -> None:
+        self.rows.append((status, str(operand)))
+
+
+def book_info(title: str) -> dict:
+    return {
+        "title": title,
+        "isbn": "9784047261273",
+        "authors": ["著者"],
+        "publisher": "出版社",
+        "category": "小説・文学",
+        "sub_category": "日本の小説",
+        "series": None
+    }
+
+
+class TestReadJobs(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_rows(self):
+        pdf = self.tmp / "本.pdf"
+        pdf.touch()
+        jobs = list(read_jobs([[str(pdf), "978-4-04-726127-3"], [str(pdf), "409126168X"],
+                               [str(pdf), "9784047261274"], [str(pdf), "/books/小説"],
+                               [str(self.tmp / "無い.pdf"), "/books/小説"]]))
+        self.assertEqual(("9784047261273", None), (jobs[0].isbn, jobs[0].dst))
+        self.assertEqual("9784091261687", jobs[1].isbn)
+        self.assertIsInstance(jobs[2].error, InvalidIsbnError)
+        self.assertEqual((None, Path("/books/小説")), (jobs[3].isbn, jobs[3].dst))
+        self.assertIsNone(jobs[3].error)
+        self.assertIsInstance(jobs[4].error, FileNotFoundError)
+
+    def test_streaming_and_skip_done(self):
+        pdfs = [self.tmp / f"{i}.pdf" for i in range(3)]
+        rows = iter([[str(pdf), "/books"] for pdf in pdfs])
+        jobs = read_jobs(rows, done={str(pdfs[0])})
+        # 1行ずつ読み、処理済みの行は飛ばす
+        self.assertEqual(pdfs[1], next(jobs).path)
+        self.assertEqual([str(pdfs[2]), "/books"], next(rows))
+
+
+class TestFileCsvRow(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.output_dir = self.tmp / "output"
+        self.config = {"output_dir": str(self.output_dir)}
+        self.logger = FakeLogger()
+        self.result = self.tmp / "source.result.csv"
+        self.db = DatabaseCliant(self.tmp / "books.sqlite3", autocommit=False)
+
+    def tearDown(self):
+        self.db.close()
+        self._tmp.cleanup()
+
+    def make_pdfs(self, n: int) -> list:
+        pdfs = []
+        for i in range(n):
+            pdf = self.output_dir / "tmp" / f"{i}.pdf"
+            pdf.parent.mkdir(parents=True, exist_ok=True)
+            pdf.write_bytes(b"%PDF-" + bytes(i))
+            pdfs.append(pdf)
+        return pdfs
+
+    def read_result(self) -> list:
+        with open(self.result, newline="") as f:
+            return list(csv.reader(f))
+
+    def run_rows(self, rows: list, filer: BookFiler) -> CompletionReport:
+        report = CompletionReport(self.result)
+        for job in read_jobs(rows, report.done):
+            file_csv_row(job, self.config, self.logger, self.db, filer, report)
+        return report
+
+    def test_batched_commit_and_resume(self):
+        pdfs = self.make_pdfs(3)
+        manual = self.output_dir / "手作業"
+        rows = [[str(pdf), str(manual)] for pdf in pdfs]
+        filer = BookFiler(batch_size=2)
+        report = self.run_rows(rows, filer)
+        # batch_size行ごとに移動、データベース、結果の順に確定する
+        self.assertEqual([str(pdfs[0]), str(pdfs[1])], [row[0] for row in self.read_result()])
+        self.assertEqual(["SUCCESS"] * 2, [row[2] for row in self.read_result()])
+        self.assertEqual(1, len(report))
+        report.close()    # 3行目を確定しないまま止まった
+
+        # 再実行では確定した行を飛ばし、残りの行だけを処理する
+        filer = BookFiler(batch_size=2)
+        report = self.run_rows(rows, filer)
+        commit_batch(filer, self.db, report)
+        report.close()
+        self.assertEqual([str(pdf) for pdf in pdfs], [row[0] for row in self.read_result()])
+        self.assertEqual(sorted(str(manual / pdf.name) for pdf in pdfs),
+                         sorted(dst for _, dst in self.db.list_destinations()))
+
+    def test_isbn_row(self):
+        pdf, = self.make_pdfs(1)
+        job = BookJob(pdf, isbn="9784047261273", info=book_info("本"))
+        report = CompletionReport(self.result)
+        filer = BookFiler()
+        file_csv_row(job, self.config, self.logger, self.db, filer, report)
+        commit_batch(filer, self.db, report)
+        report.close()
+        dst = self.output_dir / "小説・文学" / "日本の小説" / "本.pdf"
+        self.assertEqual([[str(pdf), "9784047261273", "SUCCESS", str(dst)]], self.read_result())
+        self.assertTrue(dst.exists())
+
+    def test_errors_are_reported(self):
+        missing = self.tmp / "無い.pdf"
+        broken, = self.make_pdfs(1)
+        report = CompletionReport(self.result)
+        filer = BookFiler()
+        file_csv_row(BookJob(missing, error=FileNotFoundError("gone")), self.config,
+                     self.logger, self.db, filer, report)
+        # 想定外のエラーでも止めずに結果へ書く
+        file_csv_row(BookJob(broken, isbn="9784047261273", error=KeyError("unexpected")),
+                     self.config, self.logger, self.db, filer, report)
+        commit_batch(filer, self.db, report)
+        report.close()
+        self.assertEqual(["MISSING", "ERROR"], [row[2] for row in self.read_result()])
+        self.assertTrue(broken.exists())
+
+
+class TestUpdateDst(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = DatabaseCliant(Path(self._tmp.name) / "books.sqlite3")
+
+    def tearDown(self):
+        self.db.close()
+        self._tmp.cleanup()
+
+    def store(self, title: str, destination: str) -> None:
+        self.db.store({
+            "title": title,
+            "isbn": None,
+            "publishers": "pub",
+            "authors": "author",
+            "categories": "cat",
+            "destination": destination
+        })
+
+    def test_only_the_moved_book_is_updated(self):
+        # 同じ題名の別の本(上下巻など)の移動先は変えない
+        self.store("本", "/books/1/本.pdf")
+        self.store("本", "/books/2/本.pdf")
+        self.db.update_dst(Path("/books/1/本.pdf"), Path("/manual/本.pdf"))
+        self.assertEqual(["/books/2/本.pdf", "/manual/本.pdf"],
+                         sorted(dst for _, dst in self.db.list_destinations()))
+
+    def test_unknown_book_is_added(self):
+        self.store("本", "/books/1/本.pdf")
+        self.db.update_dst(Path("/input/本.pdf"), Path("/manual/本.pdf"))
+        self.assertEqual(["/books/1/本.pdf", "/manual/本.pdf"],
+                         sorted(dst for _, dst in self.db.list_destinations()))
+
+
+if __name__ == "__main__":
+    unittest.main()
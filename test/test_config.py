@@ -0,0 +1,23 @@
+import unittest
+
+from src.config import load_section
+from src.pipeline import DEFAULT_PIPELINE_CONFIG
+
+
+class TestLoadSection(unittest.TestCase):
+    def test_defaults(self):
+        config = load_section({"pipeline": {"ocr_workers": 4}}, "pipeline", DEFAULT_PIPELINE_CONFIG)
+        self.assertEqual(4, config["ocr_workers"])
+        self.assertEqual(DEFAULT_PIPELINE_CONFIG["queue_size"], config["queue_size"])
+        # 項目が無いときや空のときは既定値のまま
+        for config in ({}, {"pipeline": None}):
+            self.assertEqual(DEFAULT_PIPELINE_CONFIG,
+                             load_section(config, "pipeline", DEFAULT_PIPELINE_CONFIG))
+
+    def test_defaults_are_not_modified(self):
+        load_section({"pipeline": {"ocr_workers": 4}}, "pipeline", DEFAULT_PIPELINE_CONFIG)
+        self.assertEqual(2, DEFAULT_PIPELINE_CONFIG["ocr_workers"])
+
+
+if __name__ == "__main__":
+    unittest.main()
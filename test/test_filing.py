@@ -0,0 +1,147 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from src.filing import BookFiler, FilingVerificationError
+
+
+class TestBookFiler(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.input_dir = self.tmp / "input"
+        self.input_dir.mkdir()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def make_pdf(self, name: str, content: bytes = b"%PDF-1.4") -> Path:
+        path = self.input_dir / name
+        path.write_bytes(content)
+        return path
+
+    def test_rename(self):
+        src = self.make_pdf("a.pdf", b"a")
+        dst = self.tmp / "out" / "漫画" / "title.pdf"
+        filer = BookFiler()
+        self.assertEqual(dst, filer.move(src, dst))
+        self.assertFalse(src.exists())
+        self.assertEqual(b"a", dst.read_bytes())
+
+    def test_collision(self):
+        dst = self.tmp / "out" / "title.pdf"
+        dst.parent.mkdir()
+        dst.write_bytes(b"old")
+        filer = BookFiler()
+        first = filer.move(self.make_pdf("a.pdf", b"a"), dst)
+        second = filer.move(self.make_pdf("b.pdf", b"b"), dst)
+        self.assertEqual(dst.with_name("title_2.pdf"), first)
+        self.assertEqual(dst.with_name("title_3.pdf"), second)
+        self.assertEqual(b"old", dst.read_bytes())
+        self.assertEqual(b"b", second.read_bytes())
+
+    def test_copy_across_filesystems(self):
+        sources = [self.make_pdf(f"{i}.pdf", bytes([i]) * 1000) for i in range(3)]
+        filer = BookFiler(batch_size=2, verify="content")
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            dsts = [filer.move(src, self.tmp / "out" / src.name) for src in sources]
+            # 1バッチ目は確定し、2バッチ目は元のファイルが残っている
+            self.assertFalse(sources[0].exists())
+            self.assertTrue(sources[2].exists())
+            self.assertFalse(dsts[2].exists())
+            filer.close()
+        for i, (src, dst) in enumerate(zip(sources, dsts)):
+            self.assertFalse(src.exists())
+            self.assertEqual(bytes([i]) * 1000, dst.read_bytes())
+        self.assertEqual([], list((self.tmp / "out").glob(".*.part")))
+
+    def test_copy_verification(self):
+        src = self.make_pdf("a.pdf", b"a" * 100)
+        filer = BookFiler()
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            filer.move(src, self.tmp / "out" / "a.pdf")
+            src.write_bytes(b"changed")
+            with self.assertRaises(FilingVerificationError):
+                filer.flush()
+        self.assertTrue(src.exists())
+        self.assertFalse((self.tmp / "out" / "a.pdf").exists())
+
+    def test_verification_failure_keeps_other_books(self):
+        sources = [self.make_pdf(f"{i}.pdf", bytes([i]) * 100) for i in range(3)]
+        published = []
+        filer = BookFiler(batch_size=10)
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            dsts = [
+                filer.move(src, self.tmp / "out" / src.name, published.append) for src in sources
+            ]
+            sources[1].write_bytes(b"changed")
+            with self.assertRaises(FilingVerificationError):
+                filer.flush()
+            self.assertEqual([dsts[0], dsts[2]], published)
+            self.assertEqual([False, True, False], [src.exists() for src in sources])
+            self.assertEqual(sorted([dsts[0], dsts[2]]), sorted((self.tmp / "out").iterdir()))
+            # 残った本は次の移動で改めて確定できる
+            filer.close()
+        self.assertEqual(2, len(published))
+
+    def test_destination_taken_before_flush(self):
+        src = self.make_pdf("a.pdf", b"a")
+        dst = self.tmp / "out" / "title.pdf"
+        published = []
+        filer = BookFiler()
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            self.assertEqual(dst, filer.move(src, dst, published.append))
+            # 別のワーカーが同じタイトルの巻を先に置いた
+            dst.write_bytes(b"other")
+            dst.with_name("title_2.pdf").write_bytes(b"other")
+            filer.flush()
+        self.assertEqual([dst.with_name("title_3.pdf")], published)
+        self.assertEqual(b"a", published[0].read_bytes())
+        self.assertEqual(b"other", dst.read_bytes())
+
+    def test_on_publish(self):
+        published = []
+        filer = BookFiler(batch_size=3)
+        renamed = filer.move(self.make_pdf("a.pdf", b"a"), self.tmp / "out" / "a.pdf",
+                             published.append)
+        self.assertEqual([renamed], published)
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            copied = filer.move(self.make_pdf("b.pdf", b"b"), self.tmp / "out" / "b.pdf",
+                                published.append)
+            # コピーは確定するまで呼ばない
+            self.assertEqual([renamed], published)
+            filer.flush()
+        self.assertEqual([renamed, copied], published)
+        self.assertEqual(b"b", copied.read_bytes())
+
+    def test_publish_failure_keeps_other_books(self):
+        published = []
+
+        def publish(dst: Path) -> None:
+            if dst.name == "a.pdf":
+                raise RuntimeError("catalog is locked")
+            published.append(dst)
+
+        filer = BookFiler(batch_size=3)
+        srcs = [self.make_pdf(name) for name in ("a.pdf", "b.pdf")]
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            for src in srcs:
+                filer.move(src, self.tmp / "out" / src.name, publish)
+            with self.assertRaises(RuntimeError):
+                filer.flush()
+        # 1冊目の記録に失敗しても、2冊目の元のファイルは消えて記録される
+        self.assertEqual([self.tmp / "out" / "b.pdf"], published)
+        self.assertFalse(any(src.exists() for src in srcs))
+
+    def test_dry_run(self):
+        src = self.make_pdf("a.pdf")
+        filer = BookFiler(dry_run=True)
+        dst = self.tmp / "out" / "title.pdf"
+        self.assertEqual(dst, filer.move(src, dst))
+        self.assertEqual(dst.with_name("title_2.pdf"), filer.move(self.make_pdf("b.pdf"), dst))
+        filer.close()
+        self.assertTrue(src.exists())
+        self.assertFalse((self.tmp / "out").exists())
+        self.assertEqual([(src, dst), (self.input_dir / "b.pdf", dst.with_name("title_2.pdf"))],
+                         filer.plan)
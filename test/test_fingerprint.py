@@ -0,0 +1,170 @@
+import random
+import unittest
+from pathlib import Path
+from typing import Optional
+
+from src.fingerprint import (_N_BANDS, DEFAULT_FINGERPRINT_CONFIG, DuplicateBookError,
+                             FingerprintIndex, FingerprintMatcher, dhash, hamming, to_signed,
+                             to_unsigned)
+from src.pipeline import BookJob, BookPipeline
+
+
+class FakeImage:
+    """PIL.Imageのconvert/resize/getdataだけを持つ画像"""
+    def __init__(self, pixels: list) -> None:
+        self.pixels = pixels
+
+    def convert(self, mode: str) -> "FakeImage":
+        return self
+
+    def resize(self, size: tuple) -> "FakeImage":
+        return self
+
+    def getdata(self) -> list:
+        return self.pixels
+
+
+def fake_fingerprint(path: Path) -> dict:
+    if path.stem == "broken":
+        raise ValueError(f"cannot render {path}")
+    return {"cover_fingerprint": int(path.stem.split("-")[0], 16), "back_fingerprint": 0}
+
+
+def fake_scan(path: Path) -> str:
+    return "scanned-" + path.stem
+
+
+def flip(h: int, n_bits: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), n_bits):
+        h ^= 1 << bit
+    return h
+
+
+class TestDhash(unittest.TestCase):
+    def test_gradient(self):
+        # 左が明るいほど1になる
+        self.assertEqual(2**64 - 1, dhash(FakeImage(list(range(9, 0, -1)) * 8)))
+        self.assertEqual(0, dhash(FakeImage(list(range(9)) * 8)))
+
+    def test_signed_roundtrip(self):
+        for h in (0, 1, 2**63 - 1, 2**63, 2**64 - 1):
+            self.assertTrue(-2**63 <= to_signed(h) < 2**63)
+            self.assertEqual(h, to_unsigned(to_signed(h)))
+
+
+class TestFingerprintIndex(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.index = FingerprintIndex()
+        self.hashes = {f"/books/{i}.pdf": self.rng.getrandbits(64) for i in range(2000)}
+        for destination, h in self.hashes.items():
+            self.index.add(destination, h, f"isbn-{destination}")
+
+    def brute_force(self, h: int, threshold: int):
+        best = None
+        for destination in sorted(self.hashes):
+            distance = hamming(h, self.hashes[destination])
+            if distance <= threshold and (best is None or distance < best[1]):
+                best = (destination, distance)
+        return best
+
+    def test_same_as_brute_force(self):
+        targets = list(self.hashes.values())
+        for _ in range(300):
+            threshold = self.rng.randint(0, 8)
+            h = flip(self.rng.choice(targets), self.rng.randint(0, 10), self.rng)
+            with self.subTest(h=h, threshold=threshold):
+                self.assertEqual(self.brute_force(h, threshold), self.index.nearest(h, threshold))
+
+    def test_default_threshold_uses_bands(self):
+        # 閾値が帯の数より小さくないと鳩の巣原理が成り立たず、全件と比べることになる
+        threshold = DEFAULT_FINGERPRINT_CONFIG["threshold"]
+        self.assertLess(threshold, _N_BANDS)
+        self.assertEqual(threshold, FingerprintMatcher(self.index).threshold)
+
+    def test_not_found(self):
+        self.assertIsNone(FingerprintIndex().nearest(0, 4))
+
+
+def cover_job(cover: int, back: Optional[int] = 0x0f) -> BookJob:
+    return BookJob(Path("a.pdf"), extras={"cover_fingerprint": cover, "back_fingerprint": back})
+
+
+class TestFingerprintMatcher(unittest.TestCase):
+    def setUp(self):
+        self.index = FingerprintIndex()
+        self.index.add("/books/known.pdf", 0xff, "9784000000000", 0x0f)
+        self.index.add("/books/manual.pdf", 0xff00, None, 0x0f)
+
+    def test_reuse(self):
+        job = cover_job(0xfe, back=0x0e)
+        FingerprintMatcher(self.index, threshold=2)(job)
+        self.assertEqual("9784000000000", job.isbn)
+        self.assertEqual("/books/known.pdf", job.extras["matched_book"])
+
+    def test_duplicate(self):
+        job = cover_job(0xff)
+        FingerprintMatcher(self.index, on_match="duplicate")(job)
+        self.assertIsNone(job.isbn)
+        self.assertIsInstance(job.error, DuplicateBookError)
+
+    def test_match_without_isbn_is_duplicate(self):
+        job = cover_job(0xff00)
+        FingerprintMatcher(self.index)(job)
+        self.assertIsInstance(job.error, DuplicateBookError)
+
+    def test_no_match(self):
+        job = cover_job(0xffff)
+        FingerprintMatcher(self.index, threshold=4)(job)
+        self.assertIsNone(job.isbn)
+        self.assertIsNone(job.error)
+
+    def test_other_volume_of_the_series(self):
+        # 表紙がよく似ていても裏表紙が違えば別の巻としてOCRする
+        job = cover_job(0xfe, back=0xf0f0)
+        FingerprintMatcher(self.index)(job)
+        self.assertIsNone(job.isbn)
+        self.assertNotIn("matched_book", job.extras)
+
+    def test_back_confirms_the_right_book(self):
+        # 表紙が最も近い本ではなく、裏表紙も一致する本を選ぶ
+        self.index.add("/books/volume2.pdf", 0xfe, "9784000000001", 0xf000)
+        job = cover_job(0xfe, back=0x0f)
+        FingerprintMatcher(self.index, threshold=2)(job)
+        self.assertEqual("9784000000000", job.isbn)
+
+    def test_unconfirmed_without_back(self):
+        self.index.add("/books/old.pdf", 0xf0f0, "9784000000002")
+        for job in (cover_job(0xf0f0), cover_job(0xff, back=None)):
+            FingerprintMatcher(self.index)(job)
+            self.assertIsNone(job.isbn)
+            self.assertIsNone(job.error)
+
+    def test_unknown_on_match(self):
+        with self.assertRaises(ValueError):
+            FingerprintMatcher(self.index, on_match="ignore")
+
+
+class TestPipelineShortcut(unittest.TestCase):
+    def test_matched_books_skip_ocr(self):
+        index = FingerprintIndex()
+        index.add("/books/known.pdf", 0xff, "known-isbn", 0)
+        filed = {}
+
+        def file(job: BookJob) -> None:
+            filed[job.path.stem] = job
+
+        pipeline = BookPipeline(fake_scan, lambda: (lambda isbn: {"isbn": isbn}),
+                                ocr_workers=1, lookup_workers=1,
+                                fingerprint=fake_fingerprint, match=FingerprintMatcher(index))
+        pipeline.run([BookJob(Path(name)) for name in ("fe.pdf", "ff00.pdf", "broken.pdf")],
+                     file)
+        self.assertEqual({"isbn": "known-isbn"}, filed["fe"].info)
+        self.assertEqual({"isbn": "scanned-ff00"}, filed["ff00"].info)
+        self.assertEqual(0xff00, filed["ff00"].extras["cover_fingerprint"])
+        # 指紋を取れなくてもOCRは続ける
+        self.assertEqual({"isbn": "scanned-broken"}, filed["broken"].info)
+
+
+if __name__ == "__main__":
+    unittest.main()
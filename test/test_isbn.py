@@ -0,0 +1,75 @@
+import unittest
+
+from src import isbn
+from src.isbn import IsbnVoter
+
+
+class TestIsbn(unittest.TestCase):
+    def test_validation(self):
+        self.assertTrue(isbn.is_valid_isbn13("9784047261273"))
+        self.assertFalse(isbn.is_valid_isbn13("9784047261274"))
+        self.assertFalse(isbn.is_valid_isbn13("1924047261273"))
+        self.assertTrue(isbn.is_valid_isbn10("409126168X"))
+        self.assertTrue(isbn.is_valid_isbn10("409126168x"))
+        self.assertFalse(isbn.is_valid_isbn10("4091261681"))
+
+    def test_to_isbn13(self):
+        self.assertEqual("9784091261687", isbn.to_isbn13("4-09-126168-X"))
+        self.assertEqual("9784047261273", isbn.to_isbn13("978-4-04-726127-3"))
+        # 欠けたコードは補わない
+        self.assertIsNone(isbn.to_isbn13("978404726127"))
+        self.assertIsNone(isbn.to_isbn13("409126168"))
+
+    def test_find_candidates(self):
+        text = "ISBN 978-4-04-726127-3\nC0193 ¥600E\n9784047261273\n1920193006002"
+        self.assertEqual([("9784047261273", isbn.PREFIXED_WEIGHT),
+                          ("9784047261273", isbn.BARE_WEIGHT)], isbn.find_candidates(text))
+        self.assertEqual([("9784091261687", isbn.PREFIXED_WEIGHT)],
+                         isbn.find_candidates("ISBN4-09-126168-X"))
+        # チェックディジットの合わない誤読は候補にしない
+        self.assertEqual([], isbn.find_candidates("ISBN978-4-04-726127-8 ISBN978404726127"))
+        # 末尾の欠けたISBN-13の先頭10桁はISBN-10のチェックディジットが合っても候補にしない
+        self.assertEqual([], isbn.find_candidates("ISBN978488459323"))
+        self.assertEqual([("9784091261687", isbn.PREFIXED_WEIGHT)],
+                         isbn.find_candidates("ISBN4-09-126168-X\n1920193006002"))
+
+
+class TestIsbnVoter(unittest.TestCase):
+    def test_agreement_is_confident(self):
+        voter = IsbnVoter()
+        voter.add_text("ISBN978-4-04-726127-3")
+        self.assertFalse(voter.is_confident())
+        voter.add_text("9784047261273")
+        self.assertTrue(voter.is_confident())
+        self.assertEqual("9784047261273", voter.best())
+
+    def test_lone_prefixed_candidate_is_confident(self):
+        # 奥付の"ISBN"付きの番号しか無い本でも、次のページに別の候補が無ければ止める
+        voter = IsbnVoter()
+        voter.add_text("ISBN978-4-04-726127-3")
+        self.assertFalse(voter.is_confident())
+        voter.add_text("あとがき")
+        self.assertTrue(voter.is_confident())
+        self.assertEqual("9784047261273", voter.best())
+
+    def test_competitor_keeps_reading(self):
+        voter = IsbnVoter()
+        voter.add_text("ISBN978-4-04-726127-3")
+        voter.add_text("9784091261687")
+        voter.add_text("あとがき")
+        self.assertFalse(voter.is_confident())
+        # "ISBN"の無い候補だけでは止めない
+        voter = IsbnVoter()
+        voter.add_text("9784091261687")
+        voter.add_text("あとがき")
+        self.assertFalse(voter.is_confident())
+
+    def test_votes(self):
+        voter = IsbnVoter()
+        self.assertIsNone(voter.best())
+        voter.add_text("9784091261687")
+        voter.add_text("ISBN9784047261273")
+        self.assertEqual("9784047261273", voter.best())
+        self.assertFalse(voter.is_confident())
+        voter.add_text("9784091261687 9784091261687")
+        self.assertEqual("9784091261687", voter.best())
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from src.lease import LeaseManager, claimed_path, default_owner, exclusive_lock, original_path
+
+
+def work(input_dir: str, done_dir: str, owner: str) -> list:
+    """確保できたpdfをdone_dirに移すワーカー"""
+    manager = LeaseManager(owner, ttl=60)
+    processed = []
+    with manager.heartbeat():
+        for claimed in manager.claims(Path(input_dir)):
+            name = original_path(claimed).name
+            os.rename(claimed, Path(done_dir) / f"{owner}-{name}")
+            manager.release(claimed)
+            processed.append(name)
+    return processed
+
+
+class TestLeaseManager(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.input_dir = self.tmp / "input"
+        (self.input_dir / "sub").mkdir(parents=True)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_claimed_path(self):
+        path = Path("/a/b.c.pdf")
+        self.assertEqual(Path("/a/b.c.pdf.w1.claimed"), claimed_path(path, "w1"))
+        self.assertEqual(path, original_path(claimed_path(path, "w1")))
+        self.assertEqual(path, original_path(path))
+
+    def test_default_owner_survives_restart(self):
+        # 再起動してもカタログ(books.[owner].sqlite3)と確保を引き継げるようにpidを含めない
+        with mock.patch("socket.gethostname", return_value="nas.example.local"):
+            self.assertEqual("nas", default_owner())
+            self.assertEqual("nas", LeaseManager().owner)
+        with mock.patch("socket.gethostname", return_value="my_host"):
+            self.assertEqual("my-host", default_owner())
+
+    def test_workers_process_each_file_once(self):
+        names = {f"{i}.pdf" for i in range(200)}
+        for i, name in enumerate(sorted(names)):
+            (self.input_dir / ("sub" if i % 2 else "") / name).touch()
+        done_dir = self.tmp / "done"
+        done_dir.mkdir()
+
+        with multiprocessing.Pool(4) as pool:
+            results = pool.starmap(work, [(str(self.input_dir), str(done_dir), f"w{i}")
+                                          for i in range(4)])
+        processed = [name for result in results for name in result]
+        self.assertEqual(len(names), len(processed))
+        self.assertEqual(names, set(processed))
+        self.assertEqual(len(names), len(list(done_dir.iterdir())))
+        self.assertEqual([], list(self.input_dir.glob("**/*.pdf*")))
+
+    def test_expired_lease_is_taken_over(self):
+        pdf = self.input_dir / "a.pdf"
+        pdf.touch()
+        crashed = LeaseManager("crashed", ttl=0.2)
+        claimed = crashed.claim(pdf)
+        self.assertIsNotNone(claimed)
+
+        other = LeaseManager("other", ttl=0.2)
+        self.assertEqual([], list(other.claims(self.input_dir)))
+        time.sleep(0.3)
+        self.assertEqual([claimed_path(pdf, "other")], list(other.claims(self.input_dir)))
+        crashed.renew()
+        self.assertEqual(set(), crashed.held)
+
+    def test_unprocessed_files_are_returned(self):
+        (self.input_dir / "a.pdf").touch()
+        (self.input_dir / "b.pdf").touch()
+        manager = LeaseManager("w", ttl=60)
+        with manager.heartbeat():
+            next(manager.claims(self.input_dir))
+        self.assertEqual(["a.pdf", "b.pdf"], sorted(p.name for p in self.input_dir.glob("*.pdf*")))
+
+    def test_same_owner_cannot_run_twice(self):
+        pdf = self.input_dir / "a.pdf"
+        pdf.touch()
+        catalog = self.tmp / "books.w.sqlite3"
+        first = LeaseManager("w", ttl=60)
+        second = LeaseManager("w", ttl=60)
+        with first.exclusive(catalog):
+            self.assertEqual([claimed_path(pdf, "w")], list(first.claims(self.input_dir)))
+            # lockが無ければ同じ名前の確保を自分のものとみなさない
+            self.assertEqual([], list(second.claims(self.input_dir)))
+            with self.assertRaises(TimeoutError):
+                with second.exclusive(catalog):
+                    pass
+
+    def test_same_owner_resumes_after_crash(self):
+        pdf = self.input_dir / "a.pdf"
+        pdf.touch()
+        LeaseManager("w", ttl=60).claim(pdf)
+        restarted = LeaseManager("w", ttl=60)
+        with restarted.exclusive(self.tmp / "books.w.sqlite3"):
+            self.assertEqual([claimed_path(pdf, "w")], list(restarted.claims(self.input_dir)))
+
+    def test_exclusive_lock(self):
+        target = self.tmp / "books.sqlite3"
+        with exclusive_lock(target):
+            with self.assertRaises(TimeoutError):
+                with exclusive_lock(target, wait_seconds=0.2):
+                    pass
+        with exclusive_lock(target):
+            pass
+        self.assertFalse(Path(f"{target}.lock").exists())
@@ -0,0 +1,36 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from src import metrics
+from src.metrics import RunMetrics
+
+
+class TestRunMetrics(unittest.TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(50.0, metrics.percentile(values, 50))
+        self.assertEqual(95.0, metrics.percentile(values, 95))
+        self.assertEqual(3.0, metrics.percentile([3.0], 95))
+        self.assertEqual(0.0, metrics.percentile([], 50))
+
+    def test_summary(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "metrics.jsonl"
+            m = RunMetrics(path)
+            m.record("ocr", 1.0, "a.pdf")
+            m.record("ocr", 3.0, "b.pdf")
+            m.record("lookup", 2.0, "a.pdf")
+            m.count("books", 2)
+            with m.time("filing", "b.pdf"):
+                pass
+            result = m.summary()
+            m.close()
+
+            rows = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual(4, len(rows))
+        self.assertEqual({"timing"}, {row["event"] for row in rows})
+        self.assertEqual(2, result["books"])
+        self.assertEqual(3.0, result["stages"]["ocr"]["p95"])
+        self.assertEqual(["b.pdf", "a.pdf"], [b["book"] for b in result["slowest_books"]])
@@ -0,0 +1,108 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import PyPDF2
+
+from src.metrics import RunMetrics
+from src.optimize import OptimizeError, PdfOptimizer, count_pages, optimize_pdf
+
+
+def pdf_command(pages: str) -> list:
+    """sys.argv[1]のpdfのpagesのページだけをsys.argv[2]に書き直すコマンド. 埋め込んだ余白は落ちる"""
+    return [
+        sys.executable, "-c",
+        "import sys, PyPDF2; r = PyPDF2.PdfFileReader(open(sys.argv[1], 'rb')); "
+        "w = PyPDF2.PdfFileWriter(); pages = list(range(r.getNumPages())); "
+        f"[w.addPage(r.getPage(i)) for i in pages{pages}]; w.write(open(sys.argv[2], 'wb'))",
+        "{input}", "{output}"
+    ]
+
+
+def write_pdf(path: Path, n_pages: int = 2) -> None:
+    writer = PyPDF2.PdfFileWriter()
+    for _ in range(n_pages):
+        writer.addBlankPage(100, 100)
+    writer.addMetadata({"/Padding": "0" * 1000})
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+SHRINK = pdf_command("")
+DROP_PAGE = pdf_command("[:-1]")
+# sys.argv[1]の前半だけをsys.argv[2]に書くコマンド. 途中で切れたpdfになる
+TRUNCATE = [
+    sys.executable, "-c",
+    "import sys; d = open(sys.argv[1], 'rb').read(); "
+    "open(sys.argv[2], 'wb').write(d[:len(d) // 2])",
+    "{input}", "{output}"
+]
+GROW = [
+    sys.executable, "-c",
+    "import sys; open(sys.argv[2], 'wb').write(open(sys.argv[1], 'rb').read() * 2)", "{input}",
+    "{output}"
+]
+GARBAGE = [sys.executable, "-c", "import sys; open(sys.argv[1], 'wb').write(b'x')", "{output}"]
+FAIL = [sys.executable, "-c", "import sys; sys.exit(1)"]
+
+
+class TestOptimizePdf(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.pdf = self.tmp / "book.pdf"
+        write_pdf(self.pdf)
+        self.size = self.pdf.stat().st_size
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def assert_no_leftovers(self):
+        self.assertEqual([self.pdf], list(self.tmp.iterdir()))
+
+    def test_replace_when_smaller(self):
+        result = optimize_pdf(self.pdf, [SHRINK])
+        self.assertEqual(self.size, result.original_size)
+        self.assertLess(result.optimized_size, self.size - 1000)
+        self.assertEqual(result.optimized_size, self.pdf.stat().st_size)
+        self.assertEqual(2, count_pages(self.pdf))
+        self.assert_no_leftovers()
+
+    def test_keep_when_larger(self):
+        result = optimize_pdf(self.pdf, [GROW])
+        self.assertEqual((self.size, self.size), (result.original_size, result.optimized_size))
+        self.assertEqual(self.size, self.pdf.stat().st_size)
+        self.assert_no_leftovers()
+
+    def test_failed_command(self):
+        # 失敗したもの、pdfでないもの、途中で切れたもの、ページを落としたものでは元のファイルを残す
+        for command in (FAIL, GARBAGE, TRUNCATE, DROP_PAGE):
+            with self.subTest(command=command), self.assertRaises(OptimizeError):
+                optimize_pdf(self.pdf, [command])
+            self.assertEqual(self.size, self.pdf.stat().st_size)
+            self.assert_no_leftovers()
+
+
+class TestPdfOptimizer(unittest.TestCase):
+    def test_background(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pdfs = [Path(tmp, f"{i}.pdf") for i in range(4)]
+            for pdf in pdfs:
+                write_pdf(pdf)
+            size = pdfs[0].stat().st_size
+            pdfs[3].unlink()    # 最適化する前に消えた
+            metrics = RunMetrics()
+            optimizer = PdfOptimizer([SHRINK], workers=2, metrics=metrics)
+            for pdf in pdfs:
+                optimizer.submit(pdf)
+            results = optimizer.close()
+        self.assertEqual(pdfs[:3], sorted(r.path for r in results))
+        self.assertEqual(sum(size - r.optimized_size for r in results),
+                         metrics.counters["optimize.saved_bytes"])
+        self.assertGreater(metrics.counters["optimize.saved_bytes"], 3 * 1000)
+        self.assertEqual(1, metrics.counters["error.optimize.FileNotFoundError"])
+
+
+if __name__ == "__main__":
+    unittest.main()
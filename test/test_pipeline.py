@@ -0,0 +1,115 @@
+import unittest
+from pathlib import Path
+
+from src.pipeline import BookJob, BookPipeline
+
+
+def fake_scan(path: Path) -> str:
+    if path.stem == "broken":
+        raise ValueError(f"cannot read {path}")
+    return "isbn-" + path.stem
+
+
+class FakeLookup:
+    closed = []
+    calls = []
+
+    def __call__(self, isbn: str) -> dict:
+        FakeLookup.calls.append(isbn)
+        if isbn == "isbn-unknown":
+            raise KeyError(isbn)
+        return {"title": isbn}
+
+    def close(self) -> None:
+        FakeLookup.closed.append(self)
+
+
+class TestBookPipeline(unittest.TestCase):
+    def run_pipeline(self, jobs: list, **kwargs) -> dict:
+        filed = {}
+
+        def file(job: BookJob) -> None:
+            filed[job.path.stem] = job
+
+        BookPipeline(fake_scan, FakeLookup, **kwargs).run(jobs, file)
+        return filed
+
+    def test_all_jobs_reach_filing(self):
+        jobs = [BookJob(Path(f"{i}.pdf")) for i in range(30)]
+        filed = self.run_pipeline(jobs, ocr_workers=2, lookup_workers=3, queue_size=2)
+        self.assertEqual({str(i) for i in range(30)}, set(filed))
+        self.assertEqual({"title": "isbn-7"}, filed["7"].info)
+
+    def test_errors_are_passed_to_filing(self):
+        jobs = [BookJob(Path("broken.pdf")), BookJob(Path("unknown.pdf"))]
+        filed = self.run_pipeline(jobs, ocr_workers=1, lookup_workers=1)
+        self.assertIsInstance(filed["broken"].error, ValueError)
+        self.assertIsNone(filed["broken"].info)
+        self.assertIsInstance(filed["unknown"].error, KeyError)
+
+    def test_skip_stages(self):
+        jobs = [
+            BookJob(Path("a.pdf"), isbn="given"),
+            BookJob(Path("b.pdf"), dst=Path("somewhere")),
+        ]
+        filed = self.run_pipeline(jobs, ocr_workers=1, lookup_workers=1)
+        self.assertEqual({"title": "given"}, filed["a"].info)
+        self.assertIsNone(filed["b"].isbn)
+        self.assertIsNone(filed["b"].info)
+
+    def test_duplicated_isbn_is_looked_up_once(self):
+        FakeLookup.calls.clear()
+        jobs = [BookJob(Path(f"{i}.pdf"), isbn=f"isbn-{i % 3}") for i in range(12)]
+        jobs.append(BookJob(Path("x.pdf"), isbn="isbn-unknown"))
+        jobs.append(BookJob(Path("y.pdf"), isbn="isbn-unknown"))
+        filed = self.run_pipeline(jobs, ocr_workers=1, lookup_workers=4)
+        self.assertEqual(4, len(FakeLookup.calls))
+        self.assertEqual({"title": "isbn-1"}, filed["10"].info)
+        self.assertIsNot(filed["1"].info, filed["4"].info)
+        self.assertIsInstance(filed["y"].error, KeyError)
+
+    def test_jobs_with_error_skip_all_stages(self):
+        filed = self.run_pipeline([BookJob(Path("a.pdf"), isbn="1", error=OSError())],
+                                  ocr_workers=1,
+                                  lookup_workers=1)
+        self.assertIsNone(filed["a"].info)
+
+    def test_lookup_clients_are_closed(self):
+        FakeLookup.closed.clear()
+        self.run_pipeline([BookJob(Path("a.pdf"))], ocr_workers=1, lookup_workers=3)
+        self.assertEqual(3, len(FakeLookup.closed))
+
+    def test_idle_lookup_workers_do_not_start_clients(self):
+        FakeLookup.closed.clear()
+        jobs = [BookJob(Path(f"{i}.pdf")) for i in range(10)]
+        p = BookPipeline(fake_scan, FakeLookup, ocr_workers=3, lookup_workers=3)
+        p.ocr_limit.set(1)
+        p.lookup_limit.set(1)
+        filed = {}
+        p.run(jobs, lambda job: filed.setdefault(job.path.stem, job))
+        self.assertEqual(10, len(filed))
+        self.assertEqual(1, len(FakeLookup.closed))
+
+    def test_limits_change_while_running(self):
+        jobs = [BookJob(Path(f"{i}.pdf")) for i in range(40)]
+        p = BookPipeline(fake_scan, FakeLookup, ocr_workers=3, lookup_workers=3, queue_size=2)
+        filed = {}
+
+        def file(job: BookJob) -> None:
+            filed[job.path.stem] = job
+            # 1から3の間で上限を上げ下げする
+            p.ocr_limit.set(len(filed) % 3 + 1)
+            p.lookup_limit.set((len(filed) + 1) % 3 + 1)
+            self.assertLessEqual(sum(p.queue_depths().values()), 6)
+
+        p.run(jobs, file)
+        self.assertEqual({str(i) for i in range(40)}, set(filed))
+        self.assertEqual({}, p.queue_depths())
+
+    def test_filing_error_aborts(self):
+        def file(job: BookJob) -> None:
+            raise RuntimeError("disk full")
+
+        jobs = (BookJob(Path(f"{i}.pdf")) for i in range(100))
+        with self.assertRaises(RuntimeError):
+            BookPipeline(fake_scan, FakeLookup, queue_size=1).run(jobs, file)
@@ -0,0 +1,136 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from src.databese import DatabaseCliant
+from src.reconcile import (ReconcileSafetyError, derive_book, plan_reconciliation, reconcile,
+                           scan_output_dir)
+
+
+def book(title: str, destination: str) -> dict:
+    return {
+        "title": title,
+        "isbn": None,
+        "publishers": "pub",
+        "authors": "author",
+        "categories": "cat",
+        "destination": destination
+    }
+
+
+class TestPlanReconciliation(unittest.TestCase):
+    def test_unchanged(self):
+        plan = plan_reconciliation({"/out/a/b/本.pdf"}, [(1, "/out/a/b/本.pdf")])
+        self.assertEqual(1, plan.n_unchanged)
+        self.assertEqual(([], [], []), (plan.moved, plan.added, plan.deleted))
+
+    def test_moved_by_basename(self):
+        plan = plan_reconciliation({"/out/新/本.pdf"}, [(1, "/out/旧/本.pdf")])
+        self.assertEqual([(1, "/out/新/本.pdf")], plan.moved)
+        self.assertEqual(([], []), (plan.added, plan.deleted))
+
+    def test_moved_by_title_key(self):
+        # ファイル名が変わっても付加情報を除いたタイトルが同じなら移動とみなす
+        plan = plan_reconciliation({"/out/新/本【電子版】.pdf"}, [(1, "/out/旧/本.pdf")])
+        self.assertEqual([(1, "/out/新/本【電子版】.pdf")], plan.moved)
+
+    def test_added_and_deleted(self):
+        plan = plan_reconciliation({"/out/a/新刊.pdf"}, [(1, "/out/a/絶版.pdf")])
+        self.assertEqual([], plan.moved)
+        self.assertEqual(["/out/a/新刊.pdf"], plan.added)
+        self.assertEqual([1], plan.deleted)
+
+    def test_ambiguous_basename_is_not_moved(self):
+        # 同じファイル名の本が2冊とも動いたときはどちらがどちらか分からない
+        on_disk = {"/out/x/上巻.pdf", "/out/y/上巻.pdf"}
+        plan = plan_reconciliation(on_disk, [(1, "/out/a/上巻.pdf"), (2, "/out/b/上巻.pdf")])
+        self.assertEqual([], plan.moved)
+        self.assertEqual(sorted(on_disk), plan.added)
+        self.assertEqual([1, 2], plan.deleted)
+
+    def test_ambiguous_candidates_are_not_moved(self):
+        on_disk = {"/out/x/本.pdf", "/out/y/本.pdf"}
+        plan = plan_reconciliation(on_disk, [(1, "/out/a/本.pdf")])
+        self.assertEqual([], plan.moved)
+        self.assertEqual([1], plan.deleted)
+
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.output_dir = self.tmp / "output"
+        self.db = DatabaseCliant(self.tmp / "books.sqlite3")
+
+    def tearDown(self):
+        self.db.close()
+        self._tmp.cleanup()
+
+    def touch(self, relative: str) -> str:
+        path = self.output_dir / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+        return str(path)
+
+    def test_scan_output_dir(self):
+        expected = {
+            self.touch("直下.pdf"),
+            self.touch("小説/本.pdf"),
+            self.touch("小説/文庫/シリーズ/1巻.pdf")
+        }
+        self.touch("tmp/失敗.pdf")
+        self.touch("duplicates/重複.pdf")
+        self.touch("小説/文庫/.書きかけ.pdf.part")
+        self.touch("小説/文庫/メモ.txt")
+        self.assertEqual(expected, scan_output_dir(self.output_dir, n_workers=2))
+
+    def test_derive_book(self):
+        path = self.touch("小説/文庫/シリーズ/1巻.pdf")
+        self.assertEqual({
+            "title": "1巻",
+            "categories": "小説",
+            "destination": path
+        }, derive_book(self.output_dir, path))
+        self.assertIsNone(derive_book(self.output_dir, self.touch("直下.pdf"))["categories"])
+
+    def test_apply(self):
+        kept = self.touch("小説/残る.pdf")
+        moved = self.touch("新/動いた.pdf")
+        added = self.touch("漫画/新刊.pdf")
+        self.db.store(book("残る", kept))
+        self.db.store(book("動いた", str(self.output_dir / "旧/動いた.pdf")))
+        self.db.store(book("残る2", self.touch("小説/残る2.pdf")))
+        self.db.store(book("消えた", str(self.output_dir / "小説/消えた.pdf")))
+
+        plan = reconcile(self.output_dir, self.db, n_workers=2)
+        self.assertEqual(2, plan.n_unchanged)
+        self.assertEqual([added], plan.added)
+        self.assertEqual(1, len(plan.deleted))
+        destinations = sorted(dst for _, dst in self.db.list_destinations())
+        self.assertEqual(sorted([kept, moved, added, str(self.output_dir / "小説/残る2.pdf")]),
+                         destinations)
+
+    def test_refuse_empty_output_dir(self):
+        self.output_dir.mkdir()
+        self.db.store(book("本", str(self.output_dir / "小説/本.pdf")))
+        with self.assertRaises(ReconcileSafetyError):
+            reconcile(self.output_dir, self.db, n_workers=2)
+        self.assertEqual(1, len(self.db.list_destinations()))
+        # dry runは何も変えないので止めない
+        self.assertEqual(1, len(reconcile(self.output_dir, self.db, dry_run=True).deleted))
+        reconcile(self.output_dir, self.db, force=True)
+        self.assertEqual([], self.db.list_destinations())
+
+    def test_refuse_mass_deletion(self):
+        self.db.store(book("残る", self.touch("小説/残る.pdf")))
+        for i in range(2):
+            self.db.store(book(f"消えた{i}", str(self.output_dir / f"小説/消えた{i}.pdf")))
+        with self.assertRaises(ReconcileSafetyError):
+            reconcile(self.output_dir, self.db, n_workers=2)
+        self.assertEqual(3, len(self.db.list_destinations()))
+        reconcile(self.output_dir, self.db, n_workers=2, force=True)
+        self.assertEqual(1, len(self.db.list_destinations()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from src.databese import DatabaseCliant
+from src.filing import BookFiler
+from src.pipeline import BookJob
+from src.run import file_book, merge_worker_catalog, send_err_dir, worker_catalog_path
+
+
+class FakeLogger:
+    def __init__(self) -> None:
+        self.rows = []
+
+    def write(self, status: str, operand) -> None:
+        self.rows.append((status, str(operand)))
+
+
+def book(title: str, destination: str) -> dict:
+    return {
+        "title": title,
+        "isbn": "9784047261273",
+        "publishers": "出版社",
+        "authors": "著者",
+        "categories": "小説・文学",
+        "destination": destination
+    }
+
+
+class TestSendErrDir(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.output_dir = self.tmp / "output"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_move(self):
+        pdf = self.tmp / "本.pdf"
+        pdf.touch()
+        published = []
+        filer = BookFiler()
+        send_err_dir(pdf, self.output_dir, filer, on_publish=published.append)
+        filer.close()
+        self.assertEqual([self.output_dir / "tmp" / "本.pdf"], published)
+        self.assertFalse(pdf.exists())
+
+    def test_already_in_err_dir(self):
+        # 補完用のcsvで再び失敗した本は自分自身と衝突させて"_2"を付けない
+        pdf = self.output_dir / "tmp" / "本.pdf"
+        pdf.parent.mkdir(parents=True)
+        pdf.touch()
+        published = []
+        filer = BookFiler()
+        send_err_dir(pdf, self.output_dir, filer, on_publish=published.append)
+        send_err_dir(pdf, self.output_dir)
+        filer.close()
+        self.assertEqual([pdf], published)
+        self.assertEqual([pdf], list((self.output_dir / "tmp").iterdir()))
+
+
+class TestFileBook(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.config = {"output_dir": str(self.tmp / "output")}
+        self.logger = FakeLogger()
+        self.db = DatabaseCliant(self.tmp / "books.sqlite3")
+
+    def tearDown(self):
+        self.db.close()
+        self._tmp.cleanup()
+
+    def test_writes_wait_for_copy(self):
+        pdf = self.tmp / "scan.pdf"
+        pdf.write_bytes(b"%PDF-book")
+        info = {
+            "title": "本",
+            "isbn": "9784047261273",
+            "authors": ["著者"],
+            "publisher": "出版社",
+            "category": "小説・文学",
+            "sub_category": "日本の小説",
+            "series": None
+        }
+        job = BookJob(pdf, info=info, extras={"cover_fingerprint": 0xff})
+        published = []
+        filer = BookFiler()
+        with mock.patch.object(BookFiler, "_same_filesystem", return_value=False):
+            dst = file_book(job, self.config, self.logger, self.db, filer,
+                            on_publish=published.append)
+            # 別のファイルシステムへのコピーはflushまでログにもカタログにも書かない
+            self.assertEqual([], self.logger.rows)
+            self.assertEqual([], self.db.list_destinations())
+            self.assertEqual([], published)
+            self.assertTrue(pdf.exists())
+            filer.flush()
+        self.assertEqual([("SUCCESS", str(dst))], self.logger.rows)
+        self.assertEqual([str(dst)], [d for _, d in self.db.list_destinations()])
+        self.assertEqual([(str(dst), 0xff, None, "9784047261273")], self.db.load_fingerprints())
+        self.assertEqual([dst], published)
+        self.assertFalse(pdf.exists())
+
+
+class TestMergeWorkerCatalog(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.main_path = self.tmp / "books.sqlite3"
+        self.worker_path = worker_catalog_path(self.main_path, "host1")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_merge(self):
+        main = DatabaseCliant(self.main_path)
+        main.store(book("既存", "/books/既存.pdf"))
+        main.close()
+
+        worker = DatabaseCliant(self.worker_path)
+        worker.store(book("既存", "/books/既存.pdf"))    # 他のワーカーが先に取り込んだ本
+        book_id = worker.store(book("新刊", "/books/新刊.pdf"))
+        worker.store_fingerprint(book_id, 0xff, 0xf0)
+        worker.update_sizes([("/books/新刊.pdf", 1000, 600)])
+        worker.update_dst(Path("/input/手作業.pdf"), Path("/books/手作業.pdf"))
+        worker.close()
+
+        merge_worker_catalog(self.main_path, self.worker_path, wait_seconds=1)
+        self.assertFalse(self.worker_path.exists())
+        self.assertFalse(Path(f"{self.main_path}.lock").exists())
+
+        main = DatabaseCliant(self.main_path)
+        try:
+            self.assertEqual(["/books/手作業.pdf", "/books/新刊.pdf", "/books/既存.pdf"],
+                             sorted(dst for _, dst in main.list_destinations()))
+            self.assertEqual([("/books/新刊.pdf", 0xff, 0xf0, "9784047261273")],
+                             main.load_fingerprints())
+            row = main.connection.execute(
+                "SELECT b.original_size, b.optimized_size, c.name AS category, f.back "
+                "FROM books b JOIN categories c ON b.category_id = c.id "
+                "JOIN fingerprints f ON f.book_id = b.id WHERE b.destination = ?",
+                ("/books/新刊.pdf", )).fetchone()
+            self.assertEqual((1000, 600, "小説・文学", 0xf0), tuple(row))
+            manual = main.connection.execute(
+                "SELECT title, category_id FROM books WHERE destination = ?",
+                ("/books/手作業.pdf", )).fetchone()
+            self.assertEqual(("手作業", None), tuple(manual))
+        finally:
+            main.close()
+
+
+if __name__ == "__main__":
+    unittest.main()